@@ -0,0 +1,313 @@
+"""Offline benchmark for the RewardRole evaluation cycle.
+
+Builds a synthetic guild in memory (members, roles, text channels, active and archived forum threads and
+their message history) and runs `RewardRole.update_guild` against it twice: once with cold counters, which reads the
+history through `process_channel_or_thread`, then once more with warm counters. No network is used.
+
+Run from the repository root:
+
+    python -m benchmarks.rewardrole_cycle --members 5000 --channels 20 --threads 40 --messages-per-day 300
+"""
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import discord
+from redbot.core import data_manager
+
+DAY = 86400
+
+
+class Stats:
+    history_calls = 0
+    history_pages = 0
+    thread_listings = 0
+    messages = 0
+    role_edits = 0
+
+
+class FakeMessage:
+    __slots__ = ("id", "author", "created_at", "content")
+    attachments = ()
+
+    def __init__(self, message_id, author, created_at, content):
+        self.id = message_id
+        self.author = author
+        self.created_at = created_at
+        self.content = content
+
+
+class FakeHistoryMixin:
+    """Generates a channel's messages on demand, the same ones on every call."""
+
+    def history(self, *, limit=None, after=None, before=None):
+        return self._history(after, before)
+
+    async def _history(self, after, before):
+        after = self._snowflake(after, 0)
+        before = self._snowflake(before, discord.utils.time_snowflake(datetime.now(timezone.utc)))
+        Stats.history_calls += 1
+        rng = random.Random(self.id)
+        now = datetime.now(timezone.utc)
+        start = now - timedelta(days=self.spec.days)
+        per_day = self.spec.messages_per_day
+        yielded = 0
+        for n in range(self.spec.days * per_day):
+            created_at = start + timedelta(seconds=n * DAY / per_day)
+            message_id = discord.utils.time_snowflake(created_at) + (self.id % 4096)
+            author = rng.choice(self.spec.members)
+            link_only = rng.random() < self.spec.link_ratio
+            if not after < message_id < before:
+                continue
+            content = "https://example.com/some/page" if link_only else "hello there https://example.com"
+            if yielded % 100 == 0:
+                Stats.history_pages += 1
+            yielded += 1
+            Stats.messages += 1
+            yield FakeMessage(message_id, author, created_at, content)
+            if yielded % 100 == 0:
+                await asyncio.sleep(0)
+
+    @staticmethod
+    def _snowflake(value, default):
+        if value is None:
+            return default
+        if isinstance(value, datetime):
+            return discord.utils.time_snowflake(value)
+        return value.id
+
+
+class FakeChannelMixin(FakeHistoryMixin):
+    archived = ()
+    overwrites = {}
+
+    async def archived_threads(self, *, limit=None, private=False, before=None):
+        Stats.thread_listings += 1
+        if private:
+            return
+        for thread in sorted(self.archived, key=lambda thread: thread.archive_timestamp, reverse=True):
+            yield thread
+
+    def overwrites_for(self, obj):
+        return discord.PermissionOverwrite()
+
+    def permissions_for(self, member):
+        allowed = self.allowed_role_ids is None or any(role.id in self.allowed_role_ids for role in member.roles)
+        return discord.Permissions(send_messages=allowed)
+
+
+class FakeTextChannel(FakeChannelMixin, discord.TextChannel):
+    pass
+
+
+class FakeForumChannel(FakeChannelMixin, discord.ForumChannel):
+    pass
+
+
+class FakeThread(FakeHistoryMixin, discord.Thread):
+    pass
+
+
+class FakeRole(discord.Role):
+    members = ()
+
+
+class FakeMember:
+    def __init__(self, member_id, guild):
+        self.id = member_id
+        self.guild = guild
+        self.roles = []
+        self.mention = f"<@{member_id}>"
+
+    def is_timed_out(self):
+        return False
+
+    async def add_roles(self, *roles, reason=None):
+        Stats.role_edits += len(roles)
+        self.roles = self.roles + [role for role in roles if role not in self.roles]
+
+    async def remove_roles(self, *roles, reason=None):
+        Stats.role_edits += len(roles)
+        self.roles = [role for role in self.roles if role not in roles]
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.owner_id = 0
+        self.members = []
+        self.channels = []
+        self.threads = []  # active threads only, like the cache
+        self.roles = {}
+        self._threads = {}
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    def get_channel(self, channel_id):
+        return next((channel for channel in self.channels if channel.id == channel_id), None)
+
+    def get_thread(self, thread_id):
+        thread = self._threads.get(thread_id)
+        return thread if thread in self.threads else None
+
+
+class FakeBot:
+    def __init__(self, guild):
+        self.loop = asyncio.get_running_loop()
+        self.guilds = [guild]
+
+    async def wait_until_ready(self):
+        await asyncio.Event().wait()
+
+    def is_closed(self):
+        return False
+
+    def get_guild(self, guild_id):
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
+
+    def get_partial_messageable(self, channel_id, *, guild_id=None, type=None):
+        # Stands in for an uncached archived thread, only its history is read
+        return self.get_guild(guild_id)._threads[channel_id]
+
+
+class HistorySpec:
+    def __init__(self, members, days, messages_per_day, link_ratio):
+        self.members = members
+        self.days = days
+        self.messages_per_day = messages_per_day
+        self.link_ratio = link_ratio
+
+
+def make_role(role_id, name, guild):
+    role = object.__new__(FakeRole)
+    role.id = role_id
+    role.name = name
+    role.guild = guild
+    guild.roles[role_id] = role
+    return role
+
+
+def make_channel(cls, channel_id, guild, spec, allowed_role_ids=None):
+    channel = object.__new__(cls)
+    channel.id = channel_id
+    channel.guild = guild
+    channel.category_id = None
+    channel.spec = spec
+    channel.allowed_role_ids = allowed_role_ids
+    return channel
+
+
+def make_thread(thread_id, parent, spec, archived):
+    thread = object.__new__(FakeThread)
+    thread.id = thread_id
+    thread.guild = parent.guild
+    thread.parent_id = parent.id
+    thread.last_message_id = discord.utils.time_snowflake(datetime.now(timezone.utc))
+    thread.archive_timestamp = datetime.now(timezone.utc)
+    thread.spec = spec
+    parent.guild._threads[thread_id] = thread
+    if archived:
+        parent.archived = [*parent.archived, thread]
+    else:
+        parent.guild.threads.append(thread)
+    return thread
+
+
+def build_guild(args):
+    rng = random.Random(0)
+    guild = FakeGuild(1)
+    roles = [make_role(100 + i, f"role-{i}", guild) for i in range(args.roles)]
+    reward_roles = [make_role(200 + i, f"reward-{i}", guild) for i in range(args.roles)]
+    guild.members = [FakeMember(10_000 + i, guild) for i in range(args.members)]
+    guild._members = {member.id: member for member in guild.members}
+    for member in guild.members:
+        member.roles = rng.sample(roles, k=rng.randint(1, len(roles)))
+    for role in roles + reward_roles:
+        role.members = [member for member in guild.members if role in member.roles]
+
+    spec = HistorySpec(guild.members, args.days, args.messages_per_day, args.link_ratio)
+    for i in range(args.channels):
+        # Every fourth channel is restricted to the first role
+        allowed = {roles[0].id} if i % 4 == 3 else None
+        guild.channels.append(make_channel(FakeTextChannel, 1_000 + i, guild, spec, allowed))
+    if args.threads:
+        forum = make_channel(FakeForumChannel, 5_000, guild, spec)
+        guild.channels.append(forum)
+        # Every other thread is archived, only listing the forum's archived threads finds it
+        for i in range(args.threads):
+            make_thread(6_000 + i, forum, spec, archived=i % 2 == 1)
+
+    conditions = {
+        str(role.id): {
+            "min_messages": args.min_messages,
+            "timeframe_days": args.days,
+            "reward_role": reward_role.id,
+            "count_only_link_messages": True,
+            "excluded_roles": [],
+            "ignored_channels": [],
+            "ignored_categories": []
+        }
+        for role, reward_role in zip(roles, reward_roles)
+    }
+    return guild, conditions
+
+
+async def run_cycle(cog, guild, label):
+    for counter in ("history_calls", "history_pages", "thread_listings", "messages", "role_edits"):
+        setattr(Stats, counter, 0)
+    started = time.perf_counter()
+    await cog.update_guild(guild)
+    evaluated = time.perf_counter()
+    await asyncio.gather(*cog.role_edits.workers.values())
+    finished = time.perf_counter()
+    print(
+        f"{label:>5}: cycle {evaluated - started:8.3f}s, role edits drained {finished - evaluated:7.3f}s | "
+        f"history calls {Stats.history_calls}, pages {Stats.history_pages}, thread listings {Stats.thread_listings}, "
+        f"messages examined {Stats.messages}, role mutations {Stats.role_edits}"
+    )
+
+
+async def main(args):
+    from rewardrole.rewardrole import RewardRole
+
+    data_manager.basic_config = dict(data_manager.basic_config_default, DATA_PATH=tempfile.mkdtemp(), STORAGE_TYPE="JSON", STORAGE_DETAILS={})
+    guild, conditions = build_guild(args)
+    cog = RewardRole(FakeBot(guild))
+    await cog.cog_load()
+    await cog.config.guild(guild).roles.set(conditions)
+    await cog.config.guild(guild).role_edits_per_minute.set(10 ** 9)
+    await cog.config.guild(guild).scan_concurrency.set(args.concurrency)
+
+    print(
+        f"{args.members} members, {args.roles} conditions, {args.channels} channels, {args.threads} forum threads, "
+        f"{args.messages_per_day} messages per channel per day over {args.days} days, {args.link_ratio:.0%} link-only"
+    )
+    await run_cycle(cog, guild, "cold")
+    await run_cycle(cog, guild, "warm")
+    cog.bg_task.cancel()
+    cog.logs.task.cancel()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--roles", type=int, default=2, help="number of role conditions")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=10, help="threads in a single forum channel")
+    parser.add_argument("--messages-per-day", type=int, default=100, help="per channel or thread")
+    parser.add_argument("--days", type=int, default=7, help="timeframe of every condition")
+    parser.add_argument("--link-ratio", type=float, default=0.2, help="share of messages made of a link only")
+    parser.add_argument("--min-messages", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=4)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
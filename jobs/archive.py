@@ -0,0 +1,72 @@
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+
+class JobArchive:
+    """Archived jobs, in gzipped JSONL segments of one guild each.
+
+    A segment is written to a temporary file, fsynced and renamed into place before the store points jobs
+    to it, so a crash leaves at worst an orphan segment and never an archived job without its record.
+    The few segments paged through last are kept decompressed in memory.
+    """
+
+    cache_size = 8  # Segments kept in memory
+
+    def __init__(self, path):
+        self.path = path
+        self.cache = OrderedDict()  # (guild_id, segment) -> {job_id: job}
+
+    def guild_path(self, guild_id):
+        return os.path.join(self.path, str(guild_id))
+
+    def segment_path(self, guild_id, segment):
+        return os.path.join(self.guild_path(guild_id), f"{segment}.jsonl.gz")
+
+    async def write_segment(self, guild_id, jobs):
+        """Write jobs to a new segment, returns its name once it's on disk."""
+        segment = f"{time.time_ns()}"
+        await asyncio.get_running_loop().run_in_executor(None, self._write, guild_id, segment, jobs)
+        return segment
+
+    def _write(self, guild_id, segment, jobs):
+        os.makedirs(self.guild_path(guild_id), exist_ok=True)
+        path = self.segment_path(guild_id, segment)
+        with open(path + ".tmp", "wb") as f:
+            with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                gz.write("".join(json.dumps(job) + "\n" for job in jobs).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def read_segment(self, guild_id, segment):
+        key = (guild_id, segment)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        with gzip.open(self.segment_path(guild_id, segment), "rt", encoding="utf-8") as f:
+            jobs = {job["job_id"]: job for job in map(json.loads, f)}
+        self.cache[key] = jobs
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return jobs
+
+    def get(self, guild_id, segment, job_id):
+        return self.read_segment(guild_id, segment).get(int(job_id))
+
+    def delete_segments(self, guild_id, segments):
+        for segment in segments:
+            self.cache.pop((guild_id, segment), None)
+            try:
+                os.remove(self.segment_path(guild_id, segment))
+            except FileNotFoundError:
+                pass
+
+    def delete_guild(self, guild_id):
+        for key in [key for key in self.cache if key[0] == guild_id]:
+            del self.cache[key]
+        shutil.rmtree(self.guild_path(guild_id), ignore_errors=True)
@@ -1,9 +1,23 @@
 import discord
-from discord.ext import tasks
 from redbot.core import commands, Config, bank, app_commands
+from redbot.core.data_manager import cog_data_path
 from typing import Optional
+import asyncio
 import datetime
+import logging
 import math
+import time
+
+from .archive import JobArchive
+from .ledger import Escrow
+from .store import JobStore
+
+STATS_PAGE_SIZE = 10  # Jobs per list on a jobstats page, 10 links stay within an embed field's 1024 characters
+ARCHIVE_INTERVAL = 3600  # Seconds between two archival passes
+COMPACT_SEGMENTS = 8  # Small segments of a guild that get merged into one
+COMPACT_SEGMENT_SIZE = 1000  # Jobs under which a segment counts as small
+
+log = logging.getLogger("red.jobs")
 
 class Jobs(commands.Cog):
     def __init__(self, bot):
@@ -13,14 +27,52 @@ class Jobs(commands.Cog):
             "job_channel_id": None,
             "poster_roles": [],
             "seeker_roles": [],
-            "jobs": {},
-            "thumb_done": "https://i.imgur.com/0YBdp8p.png"
+            "jobs": {},  # Only read to migrate jobs from older versions, they are kept in the job store now
+            "thumb_done": "https://i.imgur.com/0YBdp8p.png",
+            "archive_days": 30  # Days after which completed jobs are archived, 0 to keep them live
         }
         default_user = {"jobs_posted": 0, "jobs_taken": 0}
         self.config.register_user(**default_user)
         self.config.register_guild(**default_guild)
+        self.store = None
+        self.escrow = None
+        self.escrow_task = None
+        self.archive = None
+        self.archive_task = None
+        self.views = []  # Job views registered with the bot, stopped when the cog unloads
+        # Interaction checks run on every click, they read these instead of the config and the job store
+        self.role_sets = {}  # guild_id -> {"poster_roles": set of role IDs, "seeker_roles": set of role IDs}
+        self.job_owners = {}  # (guild_id, job_id) -> creator ID, for the jobs that aren't complete
         bot.add_view(JobView(self, None))  # Registering the view as persistent
-        self.refresh_views.start()  # Start the view refresh task
+
+    async def cog_load(self):
+        self.store = JobStore(cog_data_path(self) / "jobs.sqlite3")
+        self.escrow = Escrow(self, cog_data_path(self) / "escrow.jsonl")
+        self.escrow.load()
+        self.escrow_task = asyncio.create_task(self.escrow.run())
+        self.archive = JobArchive(cog_data_path(self) / "archive")
+        self.archive_task = asyncio.create_task(self.archive_loop())
+        # Move the jobs stored in the guild config by older versions to the job store, once
+        for guild_id, guild_data in (await self.config.all_guilds()).items():
+            if guild_data.get("jobs"):
+                self.store.import_jobs(guild_id, guild_data["jobs"])
+                await self.config.guild_from_id(guild_id).jobs.clear()
+            self.cache_role_sets(guild_id, guild_data)
+        # Reattach a view to the message of every job that can still change, the buttons then work without any API call
+        for job in self.store.active_jobs():
+            self.job_owners[(job["guild_id"], job["job_id"])] = job["creator"]
+            view = JobView(self, job["job_id"])
+            view.set_status(job["status"])
+            self.bot.add_view(view, message_id=job["message_id"])
+            self.views.append(view)
+
+    async def cog_unload(self):
+        for view in self.views:
+            view.stop()
+        self.escrow_task.cancel()
+        self.archive_task.cancel()
+        self.escrow.close()
+        self.store.close()
 
     @commands.group()
     @commands.guild_only()
@@ -33,6 +85,11 @@ class Jobs(commands.Cog):
     async def reset_config(self, ctx):
         """Reset the job configuration for this server."""
         await self.config.guild(ctx.guild).clear()
+        self.store.delete_guild(ctx.guild.id)
+        self.archive.delete_guild(ctx.guild.id)
+        self.role_sets.pop(ctx.guild.id, None)
+        for key in [key for key in self.job_owners if key[0] == ctx.guild.id]:
+            del self.job_owners[key]
         await ctx.send("Cog configuration has been reset for this server.")
 
     @jobs.command(name='channel')
@@ -54,6 +111,7 @@ class Jobs(commands.Cog):
             for role in roles:
                 if role.id not in poster_roles:
                     poster_roles.append(role.id)
+        await self.reload_role_sets(ctx.guild)
         
         role_mentions = ", ".join(role.mention for role in roles)
         await ctx.send(f"Roles {role_mentions} can now create jobs.")
@@ -70,19 +128,30 @@ class Jobs(commands.Cog):
             for role in roles:
                 if role.id not in seeker_roles:
                     seeker_roles.append(role.id)
+        await self.reload_role_sets(ctx.guild)
         
         role_mentions = ", ".join(role.mention for role in roles)
         await ctx.send(f"Roles {role_mentions} can now take jobs.")
 
-    async def can_create(self, member):
+    def cache_role_sets(self, guild_id, guild_data):
+        self.role_sets[guild_id] = {
+            "poster_roles": set(guild_data.get("poster_roles", [])),
+            "seeker_roles": set(guild_data.get("seeker_roles", []))
+        }
+
+    async def reload_role_sets(self, guild):
+        """Refresh the cached poster and seeker roles after they were changed."""
+        self.cache_role_sets(guild.id, await self.config.guild(guild).all())
+
+    def can_create(self, member):
         """Check if the member can create jobs."""
-        async with self.config.guild(member.guild).poster_roles() as poster_roles:
-            return any(role.id in poster_roles for role in member.roles)
+        poster_roles = self.role_sets.get(member.guild.id, {}).get("poster_roles", ())
+        return any(role.id in poster_roles for role in member.roles)
 
-    async def can_take(self, member):
+    def can_take(self, member):
         """Check if the member can take jobs."""
-        async with self.config.guild(member.guild).seeker_roles() as seeker_roles:
-            return any(role.id in seeker_roles for role in member.roles)
+        seeker_roles = self.role_sets.get(member.guild.id, {}).get("seeker_roles", ())
+        return any(role.id in seeker_roles for role in member.roles)
         
     @jobs.command(name='setimage')
     @commands.has_guild_permissions(administrator=True)
@@ -90,7 +159,60 @@ class Jobs(commands.Cog):
         """Set the custom image for completed job embeds"""
         await self.config.guild(ctx.guild).thumb_done.set(image_url)
         await ctx.send(f"Custom image for completed jobs has been set.")
-        
+
+    @jobs.command(name='archivedays')
+    @commands.has_guild_permissions(administrator=True)
+    async def set_archive_days(self, ctx, days: int):
+        """Set after how many days completed jobs are archived, 0 to never archive them"""
+        if days < 0:
+            await ctx.send("The number of days can't be negative.")
+            return
+        await self.config.guild(ctx.guild).archive_days.set(days)
+        if days:
+            await ctx.send(f"Completed jobs will be archived after {days} days.")
+        else:
+            await ctx.send("Completed jobs will not be archived.")
+
+    async def archive_loop(self):
+        await self.bot.wait_until_ready()
+        while True:
+            for guild_id in self.store.guild_ids():
+                try:
+                    archive_days = await self.config.guild_from_id(guild_id).archive_days()
+                    if archive_days:
+                        await self.archive_guild(guild_id, time.time() - archive_days * 86400)
+                        await self.compact_archive(guild_id)
+                except Exception:
+                    log.exception("Archiving the jobs of guild %s failed, it will be tried again on the next pass", guild_id)
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+    async def archive_guild(self, guild_id, before):
+        """Move the completed jobs and those whose creation never finished out of the live store.
+
+        Open and in progress jobs stay live however old they are. Jobs whose salary is still held or
+        being paid out wait for the escrow, an unfinished job's salary is refunded to its creator first.
+        """
+        jobs = []
+        for job in self.store.archivable_jobs(guild_id, before):
+            entry = self.escrow.escrows.get((guild_id, job["job_id"]))
+            if entry is None:
+                jobs.append(job)
+            elif entry["op"] == "hold" and not job["completed"] and entry["seq"] not in self.escrow.pending:
+                await self.escrow.refund(guild_id, job["job_id"], job["creator"], entry["amount"])
+        if jobs:
+            segment = await self.archive.write_segment(guild_id, jobs)
+            self.store.archive(guild_id, jobs, segment)
+
+    async def compact_archive(self, guild_id):
+        """Merge a guild's small segments into one, so paging through the archive opens few files."""
+        small = [segment for segment, size in self.store.segment_sizes(guild_id).items() if size < COMPACT_SEGMENT_SIZE]
+        if len(small) < COMPACT_SEGMENTS:
+            return
+        jobs = [job for segment in small for job in self.archive.read_segment(guild_id, segment).values()]
+        segment = await self.archive.write_segment(guild_id, sorted(jobs, key=lambda job: job["job_id"]))
+        self.store.move_segments(guild_id, small, segment)
+        self.archive.delete_segments(guild_id, small)
+
     @jobs.command(name='showconfig')
     @commands.has_guild_permissions(administrator=True)
     async def show_config(self, ctx):
@@ -107,10 +229,12 @@ class Jobs(commands.Cog):
         poster_roles = ", ".join([f"<@&{role_id}>" for role_id in config_data.get("poster_roles", [])])
         seeker_roles = ", ".join([f"<@&{role_id}>" for role_id in config_data.get("seeker_roles", [])])
         thumb_done_url = config_data.get("thumb_done", "Not Set")
+        archive_days = config_data.get("archive_days")
 
         embed.add_field(name="Job Channel", value=job_channel, inline=False)
         embed.add_field(name="Poster Roles", value=poster_roles if poster_roles else "None", inline=False)
         embed.add_field(name="Seeker Roles", value=seeker_roles if seeker_roles else "None", inline=False)
+        embed.add_field(name="Archive Completed Jobs", value=f"After {archive_days} days" if archive_days else "Never", inline=False)
         embed.set_thumbnail(url=thumb_done_url)
 
         await ctx.send(embed=embed)
@@ -125,90 +249,51 @@ class Jobs(commands.Cog):
             await ctx.send("You do not have permission to view other users' job stats.")
             return
 
-        user_data = await self.config.user(user).all()
-        jobs_posted = user_data.get("jobs_posted", 0)
-        jobs_taken = user_data.get("jobs_taken", 0)
         default_color = await ctx.embed_color()
-        
-        # Initialize lists to store thread links
-        posted_job_links = []
-        taken_job_links = []
-
-        async with self.config.guild(ctx.guild).jobs() as jobs:
-            for job_id, job in jobs.items():
-                if job["thread_id"]:
-                    thread = ctx.guild.get_thread(job["thread_id"])
-                    if thread:
-                        job_link = f"- [{thread.name}]({thread.jump_url})"
-                        if job["creator"] == user.id:
-                            posted_job_links.append(job_link)
-                        elif job.get("taker") == user.id and job.get("completed"):
-                            taken_job_links.append(job_link)
-
-        # Create embeds for pagination if necessary
-        embeds = []
-        if len(posted_job_links) > 20 or len(taken_job_links) > 20:
-            for i in range(0, max(len(posted_job_links), len(taken_job_links)), 20):
-                embed = discord.Embed(title=f"💼 {user.display_name}'s Job Stats", color=default_color)
-                embed.add_field(name=f"Jobs Posted ({len(posted_job_links)})", value="\n".join(posted_job_links[i:i+20]), inline=True)
-                embed.add_field(name=f"Jobs Completed ({len(taken_job_links)})", value="\n".join(taken_job_links[i:i+20]), inline=True)
-                embeds.append(embed)
-
-            # Start the paginator
-            paginator = Paginator(ctx, embeds)
+        # Counted and read from the creator and taker indexes, only the jobs shown on a page are loaded,
+        # from the live store or from the archive segment they were moved to
+        posted_count, completed_count = self.store.user_job_counts(ctx.guild.id, user.id)
+        total_pages = max(math.ceil(posted_count / STATS_PAGE_SIZE), math.ceil(completed_count / STATS_PAGE_SIZE), 1)
+
+        def job_link(job):
+            title = job["title"]
+            if not title:
+                # Jobs from older versions didn't store their title, their thread has it
+                thread = ctx.guild.get_thread(job["thread_id"])
+                title = thread.name if thread else f"Job {job['job_id']}"
+            if len(title) > 25:
+                title = title[:24] + "…"
+            return f"- [{title}](https://discord.com/channels/{ctx.guild.id}/{job['thread_id']})"
+
+        def load_jobs(refs):
+            jobs = []
+            for job_id, segment in refs:
+                if segment is None:
+                    job = self.store.get(ctx.guild.id, job_id)
+                else:
+                    job = self.archive.get(ctx.guild.id, segment, job_id)
+                if job is not None:  # Archived since the page was listed
+                    jobs.append(job)
+            return jobs
+
+        def get_page(page):
+            offset = page * STATS_PAGE_SIZE
+            posted_job_links = [job_link(job) for job in load_jobs(self.store.posted_jobs(ctx.guild.id, user.id, offset, STATS_PAGE_SIZE))]
+            taken_job_links = [job_link(job) for job in load_jobs(self.store.completed_jobs(ctx.guild.id, user.id, offset, STATS_PAGE_SIZE))]
+            embed = discord.Embed(title=f"💼 {user.display_name}'s Job Stats", color=default_color)
+            embed.add_field(name=f"Jobs Posted ({posted_count})", value="\n".join(posted_job_links), inline=True)
+            embed.add_field(name=f"Jobs Completed ({completed_count})", value="\n".join(taken_job_links), inline=True)
+            if total_pages > 1:
+                embed.set_footer(text=f"Page {page + 1}/{total_pages}")
+            return embed
+
+        if total_pages > 1:
+            # Start the paginator, it builds each page when it's shown
+            paginator = Paginator(ctx, total_pages, get_page)
             await paginator.start()
         else:
             # Single embed if pagination is not needed
-            embed = discord.Embed(title=f"💼 {user.display_name}'s Job Stats", color=default_color)
-            embed.add_field(name=f"Jobs Posted ({len(posted_job_links)})", value="\n".join(posted_job_links), inline=True)
-            embed.add_field(name=f"Jobs Completed ({len(taken_job_links)})", value="\n".join(taken_job_links), inline=True)
-            await ctx.send(embed=embed)
-            
-    @tasks.loop(minutes=10)  # Run this task every 10 minutes
-    async def refresh_views(self):
-        """Refresh views on existing job posts to keep them active."""
-        for guild in self.bot.guilds:
-            job_channel_id = await self.config.guild(guild).job_channel_id()
-            if not job_channel_id:
-                continue
-
-            job_channel = guild.get_channel(job_channel_id)
-            if not job_channel:
-                continue
-
-            async with self.config.guild(guild).jobs() as jobs:
-                for job_id, job_data in jobs.items():
-                    message_id = job_data.get("message_id")
-                    if not message_id:
-                        continue
-
-                    try:
-                        job_message = await job_channel.fetch_message(message_id)
-                        if not job_message:
-                            continue
-
-                        view = JobView(self, job_id=int(job_id))
-                        view._message = job_message
-                        job_status = job_data.get("status", "open")
-                        job_taker = job_data.get("taker")
-
-                        # Disable/enable buttons based on job status
-                        for item in view.children:
-                            if isinstance(item, discord.ui.Button):
-                                if item.custom_id == "apply_button":
-                                    item.disabled = job_status != "open"
-                                elif item.custom_id == "untake_button":
-                                    item.disabled = job_status != "in_progress" or job_taker != job_message.author.id
-                                elif item.custom_id == "job_done_button":
-                                    item.disabled = job_status != "in_progress"
-
-                        await job_message.edit(view=view)
-                    except discord.NotFound:
-                        continue
-
-    @commands.Cog.listener()
-    async def on_ready(self):
-        self.refresh_views.start()  # Start the task when the bot is ready
+            await ctx.send(embed=get_page(0))
 
     @app_commands.command(name='job')
     async def add_job_slash(self, interaction: discord.Interaction, title: str, salary: int, description: str,
@@ -238,7 +323,7 @@ class Jobs(commands.Cog):
         else:
             raise TypeError("Invalid context type")
 
-        if not await self.can_create(author):
+        if not self.can_create(author):
             await context.send("You do not have permission to create jobs", ephemeral=True)
             return
 
@@ -248,19 +333,24 @@ class Jobs(commands.Cog):
             await context.send("You do not have enough credits to post this job", ephemeral=True)
             return
 
-        await bank.withdraw_credits(author, salary)
+        # The salary is held in escrow until the job is done
+        if not await self.escrow.withdraw(author, job_id, salary):
+            await context.send("You do not have enough credits to post this job", ephemeral=True)
+            return
 
-        async with self.config.guild(guild).jobs() as jobs:
-            jobs[str(job_id)] = {
-                "creator": author.id,
-                "taker": None,
-                "salary": salary,
-                "description": description,
-                "status": "open",
-                "color": color,
-                "image_url": image,
-                "completed": False
-            }
+        self.store.create(
+            guild.id, job_id,
+            creator=author.id,
+            taker=None,
+            salary=salary,
+            title=title,
+            description=description,
+            status="open",
+            color=color,
+            image_url=image
+        )
+        self.job_owners[(guild.id, job_id)] = author.id
+        await self.escrow.hold(guild.id, job_id, salary)
 
         if color:
             if color.startswith('#'):
@@ -292,7 +382,7 @@ class Jobs(commands.Cog):
 
         view = JobView(self, job_id)
         job_message = await job_channel.send(embed=embed, view=view)
-        view._message = job_message
+        self.views.append(view)
         user_data = await self.config.user(author).all()
         jobs_posted = user_data.get("jobs_posted", 0) + 1
         await self.config.user(author).jobs_posted.set(jobs_posted)
@@ -302,10 +392,7 @@ class Jobs(commands.Cog):
         thread = await job_message.create_thread(name=thread_title)
         await thread.send(embed=embed)
 
-        async with self.config.guild(guild).jobs() as jobs:
-            job = jobs[str(job_id)]
-            job["thread_id"] = thread.id
-            job["message_id"] = job_message.id
+        self.store.update(guild.id, job_id, thread_id=thread.id, message_id=job_message.id)
 
         await send_method(f"Job created with ID {job_id}", ephemeral=True)
 
@@ -314,16 +401,20 @@ class JobView(discord.ui.View):
         super().__init__(timeout=None)
         self.jobs_cog = jobs_cog
         self.job_id = job_id
-        self._message = None
+
+    def set_status(self, status):
+        """Enable the buttons that apply to a job with this status."""
+        self.apply_button.disabled = status != "open"
+        self.untake_button.disabled = status != "in_progress"
+        self.job_done_button.disabled = status != "in_progress"
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         job_id = self.job_id
         guild = interaction.guild
 
-        async with self.jobs_cog.config.guild(guild).jobs() as jobs:
-            job = jobs.get(str(job_id))
-            if job and (job["creator"] == interaction.user.id or await self.jobs_cog.can_take(interaction.user)):
-                return True
+        creator = self.jobs_cog.job_owners.get((guild.id, job_id))
+        if creator and (creator == interaction.user.id or self.jobs_cog.can_take(interaction.user)):
+            return True
         return False
 
     @discord.ui.button(label="Apply", emoji="💼", style=discord.ButtonStyle.primary, custom_id="apply_button")
@@ -334,29 +425,24 @@ class JobView(discord.ui.View):
         taker = interaction.user
         guild = interaction.guild
 
-        async with self.jobs_cog.config.guild(guild).jobs() as jobs:
-            job = jobs.get(str(job_id))
-            if not job or job["taker"]:
-                await interaction.followup.send("This job has already been taken.", ephemeral=True)
-                return
+        # The store's compare-and-set lets only one click take the job, the Discord calls come after it
+        job = self.jobs_cog.store.transition(guild.id, job_id, "open", "in_progress", taker=taker.id)
+        if not job:
+            await interaction.followup.send("This job has already been taken.", ephemeral=True)
+            return
 
-            job["taker"] = taker.id
-            job["status"] = "in_progress"
+        # Send a message in the job's thread
+        thread = guild.get_thread(job["thread_id"])
+        if thread:
+            await thread.send(f"{taker.mention} has taken the job.")
 
-            # Send a message in the job's thread
-            thread = guild.get_thread(job["thread_id"])
-            if thread:
-                await thread.send(f"{taker.mention} has taken the job.")
+        # Update the message embed and disable the apply button
+        embed = interaction.message.embeds[0]
+        embed.set_field_at(1, name="Taken by", value=taker.mention)
+        self.set_status("in_progress")
+        await interaction.message.edit(embed=embed, view=self)
 
-            # Update the message embed and disable the apply button
-            embed = self._message.embeds[0]
-            embed.set_field_at(1, name="Taken by", value=taker.mention)
-            self.children[0].disabled = True  # Apply button
-            self.children[1].disabled = False  # Untake button
-            self.children[2].disabled = False  # Job done button
-            await self._message.edit(embed=embed, view=self)
-
-            await interaction.followup.send("You have successfully applied for the job.", ephemeral=True)
+        await interaction.followup.send("You have successfully applied for the job.", ephemeral=True)
 
     @discord.ui.button(label="Untake Job", style=discord.ButtonStyle.danger, custom_id="untake_button", disabled=True)
     async def untake_button(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -366,27 +452,21 @@ class JobView(discord.ui.View):
         taker = interaction.user
         guild = interaction.guild
 
-        async with self.jobs_cog.config.guild(guild).jobs() as jobs:
-            job = jobs.get(str(job_id))
-            if not job or job["taker"] != taker.id:
-                await interaction.followup.send("You cannot untake a job you haven't taken.", ephemeral=True)
-                return
-
-            job["taker"] = None
-            job["status"] = "open"
+        job = self.jobs_cog.store.transition(guild.id, job_id, "in_progress", "open", expected={"taker": taker.id}, taker=None)
+        if not job:
+            await interaction.followup.send("You cannot untake a job you haven't taken.", ephemeral=True)
+            return
 
-            # Send a message in the job's thread
-            thread = guild.get_thread(job["thread_id"])
-            if thread:
-                await thread.send(f"{taker.mention} has untaken the job.")
+        # Send a message in the job's thread
+        thread = guild.get_thread(job["thread_id"])
+        if thread:
+            await thread.send(f"{taker.mention} has untaken the job.")
 
         # Update the message embed and enable the apply button
-        embed = self._message.embeds[0]
+        embed = interaction.message.embeds[0]
         embed.set_field_at(1, name="Taken by", value="Not yet taken")
-        self.children[0].disabled = False  # Apply button
-        self.children[1].disabled = True   # Untake button
-        self.children[2].disabled = True   # Job done button
-        await self._message.edit(embed=embed, view=self)
+        self.set_status("open")
+        await interaction.message.edit(embed=embed, view=self)
 
         await interaction.followup.send("You have untaken the job.", ephemeral=True)
 
@@ -398,58 +478,59 @@ class JobView(discord.ui.View):
         user = interaction.user
         guild = interaction.guild
 
-        async with self.jobs_cog.config.guild(guild).jobs() as jobs:
-            job = jobs.get(str(job_id))
-            if not job:
-                await interaction.followup.send("Job not found.", ephemeral=True)
-                return
-
-            # Check if the user is the job creator
-            if job["creator"] != user.id:
-                await interaction.followup.send("You are not authorized to mark this job as done.", ephemeral=True)
-                return
+        job = self.jobs_cog.store.get(guild.id, job_id)
+        if not job:
+            await interaction.followup.send("Job not found.", ephemeral=True)
+            return
 
-            if job["status"] != "in_progress":
-                await interaction.followup.send("This job cannot be marked as done.", ephemeral=True)
-                return
+        # Check if the user is the job creator
+        if job["creator"] != user.id:
+            await interaction.followup.send("You are not authorized to mark this job as done.", ephemeral=True)
+            return
 
-            # Mark the job as complete
-            job["status"] = "complete"
-            job["completed"] = True
-
-            # Pay the taker if there is one
-            taker_id = job.get("taker")
-            if taker_id:
-                taker = guild.get_member(taker_id)
-                if taker:
-                    taker_data = await self.jobs_cog.config.user(taker).all()
-                    jobs_taken = taker_data.get("jobs_taken", 0) + 1
-                    await self.jobs_cog.config.user(taker).jobs_taken.set(jobs_taken)
-                    await bank.deposit_credits(taker, job["salary"])
-
-                # Delete the initial message with buttons
-                try:
-                    await self._message.delete()
-                except discord.NotFound:
-                    pass
+        # Mark the job as complete, only one click can win
+        job = self.jobs_cog.store.transition(guild.id, job_id, "in_progress", "complete", expected={"creator": user.id})
+        if not job:
+            await interaction.followup.send("This job cannot be marked as done.", ephemeral=True)
+            return
+        # Its message goes away so the view is done
+        self.jobs_cog.job_owners.pop((guild.id, job_id), None)
+        self.stop()
+
+        # The payout is journaled here and applied by the escrow with the other pending payouts
+        taker_id = job.get("taker")
+        if taker_id:
+            await self.jobs_cog.escrow.release(guild.id, job_id, taker_id, job["salary"])
+
+        if taker_id:
+            taker = guild.get_member(taker_id)
+            if taker:
+                taker_data = await self.jobs_cog.config.user(taker).all()
+                jobs_taken = taker_data.get("jobs_taken", 0) + 1
+                await self.jobs_cog.config.user(taker).jobs_taken.set(jobs_taken)
+
+            # Delete the initial message with buttons
+            try:
+                await interaction.message.delete()
+            except discord.NotFound:
+                pass
 
-                # Send a message in the job's thread with a green-colored embed
-                completed_image_url = await self.jobs_cog.config.guild(guild).thumb_done()
-                thread = guild.get_thread(job["thread_id"])
-                creator = guild.get_member(job["creator"])
-                if thread:
-                    embed = self._message.embeds[0]
-                    embed.color = discord.Colour.green()
-                    embed.set_thumbnail(url=completed_image_url)
-                    await thread.send(embed=embed)
-                    await thread.send(f"{creator.mention} has marked the job as complete and the salary has been sent to {taker.mention}.")
+            # Send a message in the job's thread with a green-colored embed
+            completed_image_url = await self.jobs_cog.config.guild(guild).thumb_done()
+            thread = guild.get_thread(job["thread_id"])
+            if thread:
+                embed = interaction.message.embeds[0]
+                embed.color = discord.Colour.green()
+                embed.set_thumbnail(url=completed_image_url)
+                await thread.send(embed=embed)
+                await thread.send(f"{user.mention} has marked the job as complete and the salary has been sent to <@{taker_id}>.")
 
         await interaction.followup.send("Job has been marked as complete.", ephemeral=True)
 
     @discord.ui.button(label="Post a job", emoji="➕", style=discord.ButtonStyle.secondary, custom_id="post_job")
     async def post_job_button(self, interaction: discord.Interaction, button: discord.ui.Button):
         # Ensure that the user has the permission to create a job
-        if not await self.jobs_cog.can_create(interaction.user):
+        if not self.jobs_cog.can_create(interaction.user):
             await interaction.response.send_message("You do not have permission to post a job.", ephemeral=True)
             return
 
@@ -534,33 +615,39 @@ class JobPostModal(discord.ui.Modal, title="Post a New Job"):
         await interaction.followup.send(f"Job '{job_title}' created successfully!", ephemeral=True)
 
 class Paginator:
-    def __init__(self, ctx, embeds):
+    def __init__(self, ctx, total_pages, get_page):
         self.ctx = ctx
-        self.embeds = embeds
+        self.get_page = get_page
         self.current_page = 0
-        self.total_pages = len(embeds)
+        self.total_pages = total_pages
 
     async def start(self):
-        self.message = await self.ctx.send(embed=self.embeds[self.current_page])
+        self.message = await self.ctx.send(embed=self.get_page(self.current_page))
         await self.message.add_reaction("⬅️")
         await self.message.add_reaction("➡️")
-        self.bot.loop.create_task(self.reaction_check())
+        self.ctx.bot.loop.create_task(self.reaction_check())
 
     async def reaction_check(self):
         def check(reaction, user):
-            return user == self.ctx.author and str(reaction.emoji) in ["⬅️", "➡️"]
+            return user == self.ctx.author and reaction.message.id == self.message.id and str(reaction.emoji) in ["⬅️", "➡️"]
 
         while True:
             try:
-                reaction, user = await self.bot.wait_for("reaction_add", timeout=60.0, check=check)
+                reaction, user = await self.ctx.bot.wait_for("reaction_add", timeout=60.0, check=check)
                 if str(reaction.emoji) == "➡️" and self.current_page < self.total_pages - 1:
                     self.current_page += 1
-                    await self.message.edit(embed=self.embeds[self.current_page])
+                    await self.message.edit(embed=self.get_page(self.current_page))
                 elif str(reaction.emoji) == "⬅️" and self.current_page > 0:
                     self.current_page -= 1
-                    await self.message.edit(embed=self.embeds[self.current_page])
+                    await self.message.edit(embed=self.get_page(self.current_page))
 
-                await self.message.remove_reaction(reaction, user)
+                try:
+                    await self.message.remove_reaction(reaction, user)
+                except discord.Forbidden:
+                    pass  # Needs Manage Messages, the user can remove their reaction themselves
             except asyncio.TimeoutError:
-                await self.message.clear_reactions()
+                try:
+                    await self.message.clear_reactions()
+                except discord.Forbidden:
+                    pass
                 break
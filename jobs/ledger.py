@@ -0,0 +1,289 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from redbot.core import bank, errors
+
+BANK_OPS = ("withdraw", "release", "refund")  # Entries that move credits, a hold only records where they are
+
+log = logging.getLogger("red.jobs.escrow")
+
+
+class Ledger:
+    """Append-only JSONL journal. Appends made close together are written and fsynced as one batch."""
+
+    flush_delay = 0.05  # How long a batch waits for more appends before it's written
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.seq = 0
+        self.buffer = []
+        self.waiters = []
+        self.flusher = None
+
+    def load(self):
+        """Read every entry, then open the journal for appending."""
+        entries = []
+        good_length = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    # A line without its newline is a torn write from a crash, it was never acknowledged,
+                    # even if what's left of it parses. Appending after it would merge the next entry into it.
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+                    good_length += len(line)
+            os.truncate(self.path, good_length)
+        if entries:
+            self.seq = entries[-1]["seq"]
+        self.file = open(self.path, "a", encoding="utf-8")
+        return entries
+
+    async def append(self, *entries):
+        """Journal entries, returns them once they are on disk."""
+        if not entries:
+            return entries
+        waiter = asyncio.get_running_loop().create_future()
+        for entry in entries:
+            self.seq += 1
+            entry.update(seq=self.seq, time=time.time())
+            self.buffer.append(json.dumps(entry) + "\n")
+        self.waiters.append(waiter)
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self.flush())
+        await waiter
+        return entries
+
+    async def flush(self):
+        while self.buffer:
+            await asyncio.sleep(self.flush_delay)
+            lines, waiters = self.buffer, self.waiters
+            self.buffer, self.waiters = [], []
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.write, lines)
+            except Exception as e:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+            else:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+
+    def write(self, lines):
+        self.file.write("".join(lines))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+        if self.buffer:
+            self.write(self.buffer)
+        self.file.close()
+
+
+class Escrow:
+    """Credits held for jobs, with every bank operation journaled in the ledger before and after it's made.
+
+    `withdraw` takes a job's salary from its creator, `hold` records that it now backs the job, `release`
+    pays it to the taker and `refund` gives it back to the creator. A bank operation is journaled, then marked
+    `applying` with the account's balance right before it, then `applied` or `failed`. On startup, operations
+    without a final mark are replayed, the journaled balance telling whether an `applying` one went through: it must
+    be the balance before or after it, anything else is left pending for someone to check.
+    """
+
+    retry_delay = 60  # Seconds before a batch that raised is tried again
+
+    def __init__(self, cog, path):
+        self.cog = cog
+        self.ledger = Ledger(path)
+        self.pending = {}  # seq -> bank operation entry that isn't applied yet
+        self.applying = {}  # seq -> balance journaled right before applying it
+        self.loaded_seq = 0  # Last entry read at startup, only what the journal left unfinished up to it is replayed
+        self.escrows = {}  # (guild_id, job_id) -> last escrow entry of a job whose credits aren't paid out yet
+        self.bank_lock = asyncio.Lock()
+        self.payouts = asyncio.Event()
+
+    def load(self):
+        entries = {}
+        for entry in self.ledger.load():
+            op = entry["op"]
+            if op in BANK_OPS:
+                self.pending[entry["seq"]] = entries[entry["seq"]] = entry
+            elif op == "applying":
+                self.applying[entry["ref"]] = entry["balance"]
+            elif op == "retry":
+                self.applying.pop(entry["ref"], None)
+            elif op in ("applied", "failed"):
+                self.pending.pop(entry["ref"], None)
+                self.applying.pop(entry["ref"], None)
+                operation = entries.pop(entry["ref"], None)
+                if operation is not None:
+                    operation["failed"] = op == "failed"
+                    self.track(operation)
+            if "job_id" in entry:
+                self.track(entry)
+        self.loaded_seq = self.ledger.seq
+
+    def track(self, entry):
+        key = (entry["guild_id"], entry["job_id"])
+        if entry.get("failed") and entry["op"] == "withdraw":
+            self.escrows.pop(key, None)  # Nothing was taken
+        elif entry["op"] in ("release", "refund") and entry["seq"] not in self.pending:
+            self.escrows.pop(key, None)  # Paid out, nothing is held for the job anymore
+        else:
+            self.escrows[key] = entry
+
+    def close(self):
+        self.ledger.close()
+
+    async def withdraw(self, member, job_id, amount):
+        """Take a job's salary from its creator. Returns whether they had enough credits."""
+        (entry,) = await self.journal(op="withdraw", guild_id=member.guild.id, job_id=job_id, user_id=member.id, amount=amount)
+        applied = await self.apply([entry])
+        return applied.get(entry["seq"], False)
+
+    async def hold(self, guild_id, job_id, amount):
+        await self.journal(op="hold", guild_id=guild_id, job_id=job_id, amount=amount)
+
+    async def release(self, guild_id, job_id, taker_id, amount):
+        """Queue the payment of a job's salary to its taker, payouts are applied in batches."""
+        await self.journal(op="release", guild_id=guild_id, job_id=job_id, user_id=taker_id, amount=amount)
+        self.payouts.set()
+
+    async def refund(self, guild_id, job_id, creator_id, amount):
+        await self.journal(op="refund", guild_id=guild_id, job_id=job_id, user_id=creator_id, amount=amount)
+        self.payouts.set()
+
+    async def journal(self, **entry):
+        entries = await self.ledger.append(entry)
+        if entry["op"] in BANK_OPS:
+            self.pending[entry["seq"]] = entry
+        self.track(entry)
+        return entries
+
+    def member(self, entry):
+        guild = self.cog.bot.get_guild(entry["guild_id"])
+        return guild.get_member(entry["user_id"]) if guild else None
+
+    async def apply(self, entries):
+        """Apply bank operations in one batch, returns {seq: whether it was applied}.
+
+        Operations of members that can't be found stay pending and are tried again later. An unexpected
+        error stops the batch: what was applied before it is journaled, then the error is raised.
+        """
+        async with self.bank_lock:
+            balances = {}  # (guild_id, user_id) -> balance as the operations before in the batch leave it
+            batch = []
+            went_through = []  # Replayed operations whose balance shows they were made before a restart
+            for entry in entries:
+                if entry["seq"] not in self.pending:
+                    continue  # Applied by another batch while this one waited for the lock
+                member = self.member(entry)
+                if member is None:
+                    continue
+                account = (entry["guild_id"], entry["user_id"])
+                if account not in balances:
+                    balances[account] = await bank.get_balance(member)
+                change = -entry["amount"] if entry["op"] == "withdraw" else entry["amount"]
+                witness = self.applying.get(entry["seq"])
+                if witness is not None and balances[account] == witness + change:
+                    went_through.append(entry)
+                    continue
+                if witness is not None and balances[account] != witness:
+                    # Something else moved the balance since, whether this went through can't be told: leave it pending
+                    log.warning("Balance of %s changed from %s to %s since operation %s of %s credits started, not replaying it", account, witness, balances[account], entry["seq"], change)
+                    continue
+                batch.append((entry, member, balances[account]))
+                balances[account] += change
+
+            await self.ledger.append(*({"op": "applying", "ref": entry["seq"], "balance": balance} for entry, _, balance in batch if entry["seq"] not in self.applying))
+            for entry, _, balance in batch:
+                self.applying.setdefault(entry["seq"], balance)
+            results = [{"op": "applied", "ref": entry["seq"]} for entry in went_through]
+            retries = []
+            error = None
+            for index, (entry, member, _) in enumerate(batch):
+                try:
+                    if entry["op"] == "withdraw":
+                        await bank.withdraw_credits(member, entry["amount"])
+                    else:
+                        await bank.deposit_credits(member, entry["amount"])
+                except (ValueError, errors.BalanceTooHigh) as e:
+                    entry["failed"] = True
+                    results.append({"op": "failed", "ref": entry["seq"], "error": str(e)})
+                except Exception as e:
+                    # Whether this one went through is unknown, it stays pending and its balance tells on the next try.
+                    # The balances journaled for the rest of the batch assumed it did, they are journaled again then.
+                    error = e
+                    retries = [{"op": "retry", "ref": entry["seq"]} for entry, _, _ in batch[index + 1:]]
+                    break
+                else:
+                    results.append({"op": "applied", "ref": entry["seq"]})
+            await self.ledger.append(*results, *retries)
+
+        for retry in retries:
+            self.applying.pop(retry["ref"], None)
+        for result in results:
+            entry = self.pending.pop(result["ref"])
+            self.applying.pop(result["ref"], None)
+            self.track(entry)
+        if error is not None:
+            raise error
+        return {result["ref"]: result["op"] == "applied" for result in results}
+
+    async def replay(self):
+        """Finish what a crash or restart interrupted, from the journal."""
+        # Entries journaled since startup, e.g. for a job being posted right now, are finished by whoever journaled them
+        unfinished = [entry for entry in self.pending.values() if entry["seq"] <= self.loaded_seq]
+        # A job whose withdrawal never started was never posted, it must not be charged now
+        interrupted = [entry for entry in unfinished if entry["op"] == "withdraw" and entry["seq"] not in self.applying]
+        await self.ledger.append(*({"op": "failed", "ref": entry["seq"], "error": "interrupted"} for entry in interrupted))
+        for entry in interrupted:
+            entry["failed"] = True
+            del self.pending[entry["seq"]]
+            self.track(entry)
+        await self.apply([entry for entry in unfinished if entry["seq"] in self.pending])
+
+        for (guild_id, job_id), entry in list(self.escrows.items()):
+            if entry["seq"] in self.pending or entry["seq"] > self.loaded_seq:
+                continue
+            job = self.cog.store.get(guild_id, job_id)
+            if entry["op"] == "withdraw":
+                # Withdrawn but never held: keep it for the job if it was saved, or give it back
+                if job:
+                    await self.hold(guild_id, job_id, entry["amount"])
+                else:
+                    await self.refund(guild_id, job_id, entry["user_id"], entry["amount"])
+            elif entry["op"] == "hold" and job and job["status"] == "complete":
+                # Completed but the payout was never queued
+                await self.release(guild_id, job_id, job["taker"], entry["amount"])
+
+    async def run(self):
+        """Replay the journal once the bot is ready, then pay out released salaries in batches."""
+        await self.cog.bot.wait_until_ready()
+        try:
+            await self.replay()
+        except Exception:
+            log.exception("Replaying the escrow journal failed, pending payouts will be retried")
+            self.retry_later()
+        while True:
+            await self.payouts.wait()
+            self.payouts.clear()
+            await asyncio.sleep(1)  # Let more completions join the batch
+            try:
+                await self.apply([entry for entry in self.pending.values() if entry["op"] != "withdraw"])
+            except Exception:
+                log.exception("Applying a batch of payouts failed, it will be retried")
+                self.retry_later()
+
+    def retry_later(self):
+        asyncio.get_running_loop().call_later(self.retry_delay, self.payouts.set)
@@ -0,0 +1,207 @@
+import sqlite3
+import time
+
+import discord
+
+# Columns of a job record, besides the guild and job IDs
+FIELDS = ("creator", "taker", "salary", "title", "description", "status", "color", "image_url", "thread_id", "message_id")
+
+# The status changes a job can go through
+TRANSITIONS = {("open", "in_progress"), ("in_progress", "open"), ("in_progress", "complete")}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    guild_id INTEGER NOT NULL,
+    job_id INTEGER NOT NULL,
+    creator INTEGER NOT NULL,
+    taker INTEGER,
+    salary INTEGER NOT NULL,
+    title TEXT,
+    description TEXT,
+    status TEXT NOT NULL DEFAULT 'open',
+    color TEXT,
+    image_url TEXT,
+    thread_id INTEGER,
+    message_id INTEGER,
+    updated_at REAL,
+    PRIMARY KEY (guild_id, job_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_by_creator ON jobs (guild_id, creator);
+CREATE INDEX IF NOT EXISTS jobs_by_taker ON jobs (guild_id, taker);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (guild_id, status);
+CREATE TABLE IF NOT EXISTS archived_jobs (
+    guild_id INTEGER NOT NULL,
+    job_id INTEGER NOT NULL,
+    creator INTEGER NOT NULL,
+    taker INTEGER,
+    status TEXT NOT NULL,
+    thread_id INTEGER,
+    segment TEXT NOT NULL,
+    PRIMARY KEY (guild_id, job_id)
+);
+CREATE INDEX IF NOT EXISTS archived_jobs_by_creator ON archived_jobs (guild_id, creator);
+CREATE INDEX IF NOT EXISTS archived_jobs_by_taker ON archived_jobs (guild_id, taker);
+CREATE INDEX IF NOT EXISTS archived_jobs_by_segment ON archived_jobs (guild_id, segment);
+"""
+
+
+class JobStore:
+    """Job records in an SQLite database, one row per job.
+
+    Reads and updates only touch the job they are about, and the creator, taker and status indexes
+    answer the per-user and per-status lookups without going through every job of the guild.
+    Archived jobs leave the `jobs` table, `archived_jobs` only keeps what's needed to find them in their segment.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode = WAL")
+        # Commits run on the event loop, with WAL they only need to reach the log, it's synced at checkpoints
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(SCHEMA)
+        # Databases created before jobs were archived don't have the update time yet
+        if "updated_at" not in {row["name"] for row in self.db.execute("PRAGMA table_info(jobs)")}:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN updated_at REAL")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["completed"] = job["status"] == "complete"
+        return job
+
+    def get(self, guild_id, job_id):
+        row = self.db.execute("SELECT * FROM jobs WHERE guild_id = ? AND job_id = ?", (guild_id, int(job_id))).fetchone()
+        return self._to_dict(row)
+
+    def create(self, guild_id, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(("guild_id", "job_id", *fields))
+        placeholders = ", ".join("?" * (len(fields) + 2))
+        with self.db:
+            self.db.execute(f"INSERT INTO jobs ({columns}) VALUES ({placeholders})", (guild_id, int(job_id), *fields.values()))
+
+    def update(self, guild_id, job_id, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self.db:
+            self.db.execute(f"UPDATE jobs SET {assignments} WHERE guild_id = ? AND job_id = ?", (*fields.values(), guild_id, int(job_id)))
+
+    def transition(self, guild_id, job_id, from_status, to_status, expected=None, **fields):
+        """Move a job from `from_status` to `to_status`, setting `fields`, if it still has that status.
+
+        `expected` maps more columns to the values they must have, e.g. the taker for untaking a job.
+        Returns the job as it was before the change, or None if it didn't match and nothing changed.
+        """
+        if (from_status, to_status) not in TRANSITIONS:
+            raise ValueError(f"A job can't go from {from_status} to {to_status}")
+        expected = dict(expected or {}, status=from_status)
+        job = self.get(guild_id, job_id)
+        if job is None or any(job[name] != value for name, value in expected.items()):
+            return None
+        fields["status"] = to_status
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        conditions = " AND ".join(f"{name} = ?" for name in expected)
+        with self.db:
+            # The conditions are checked again by the update itself, so it never overwrites a concurrent change
+            cursor = self.db.execute(f"UPDATE jobs SET {assignments} WHERE guild_id = ? AND job_id = ? AND {conditions}", (*fields.values(), guild_id, int(job_id), *expected.values()))
+        return job if cursor.rowcount == 1 else None
+
+    def guild_jobs(self, guild_id, status=None):
+        if status is None:
+            rows = self.db.execute("SELECT * FROM jobs WHERE guild_id = ? ORDER BY job_id", (guild_id,))
+        else:
+            rows = self.db.execute("SELECT * FROM jobs WHERE guild_id = ? AND status = ? ORDER BY job_id", (guild_id, status))
+        return [self._to_dict(row) for row in rows]
+
+    def active_jobs(self):
+        """Open and in progress jobs of every guild that have a message, their views need to be restored."""
+        rows = self.db.execute("SELECT * FROM jobs WHERE status IN ('open', 'in_progress') AND message_id IS NOT NULL")
+        return [self._to_dict(row) for row in rows]
+
+    def user_job_counts(self, guild_id, user_id):
+        """How many jobs a user posted, and how many of the jobs they took are complete, counting those with a thread."""
+        posted = self.db.execute(
+            "SELECT (SELECT COUNT(*) FROM jobs WHERE guild_id = ?1 AND creator = ?2 AND thread_id IS NOT NULL)"
+            " + (SELECT COUNT(*) FROM archived_jobs WHERE guild_id = ?1 AND creator = ?2 AND thread_id IS NOT NULL)",
+            (guild_id, user_id)
+        ).fetchone()[0]
+        completed = self.db.execute(
+            "SELECT (SELECT COUNT(*) FROM jobs WHERE guild_id = ?1 AND taker = ?2 AND status = 'complete' AND thread_id IS NOT NULL)"
+            " + (SELECT COUNT(*) FROM archived_jobs WHERE guild_id = ?1 AND taker = ?2 AND status = 'complete' AND thread_id IS NOT NULL)",
+            (guild_id, user_id)
+        ).fetchone()[0]
+        return posted, completed
+
+    def posted_jobs(self, guild_id, user_id, offset=0, limit=None):
+        """`(job_id, segment)` of the jobs a user posted, live or archived. The segment is None for live jobs."""
+        rows = self.db.execute(
+            "SELECT job_id, NULL AS segment FROM jobs WHERE guild_id = ?1 AND creator = ?2 AND thread_id IS NOT NULL"
+            " UNION ALL SELECT job_id, segment FROM archived_jobs WHERE guild_id = ?1 AND creator = ?2 AND thread_id IS NOT NULL"
+            " ORDER BY job_id LIMIT ?3 OFFSET ?4",
+            (guild_id, user_id, -1 if limit is None else limit, offset)
+        )
+        return [tuple(row) for row in rows]
+
+    def completed_jobs(self, guild_id, user_id, offset=0, limit=None):
+        """`(job_id, segment)` of the completed jobs a user took, like `posted_jobs`."""
+        rows = self.db.execute(
+            "SELECT job_id, NULL AS segment FROM jobs WHERE guild_id = ?1 AND taker = ?2 AND status = 'complete' AND thread_id IS NOT NULL"
+            " UNION ALL SELECT job_id, segment FROM archived_jobs WHERE guild_id = ?1 AND taker = ?2 AND status = 'complete' AND thread_id IS NOT NULL"
+            " ORDER BY job_id LIMIT ?3 OFFSET ?4",
+            (guild_id, user_id, -1 if limit is None else limit, offset)
+        )
+        return [tuple(row) for row in rows]
+
+    def guild_ids(self):
+        return [row[0] for row in self.db.execute("SELECT DISTINCT guild_id FROM jobs")]
+
+    def archivable_jobs(self, guild_id, before):
+        """Jobs not updated since the `before` timestamp that are complete, or whose creation never finished."""
+        rows = self.db.execute("SELECT * FROM jobs WHERE guild_id = ? AND (status = 'complete' OR message_id IS NULL)", (guild_id,))
+        jobs = []
+        for row in rows:
+            job = self._to_dict(row)
+            # Jobs from older versions have no update time, their ID tells when they were posted
+            updated_at = job["updated_at"] or discord.utils.snowflake_time(job["job_id"]).timestamp()
+            if updated_at < before:
+                jobs.append(job)
+        return jobs
+
+    def archive(self, guild_id, jobs, segment):
+        """Move jobs out of the live table once their segment has been written."""
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO archived_jobs (guild_id, job_id, creator, taker, status, thread_id, segment) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(guild_id, job["job_id"], job["creator"], job["taker"], job["status"], job["thread_id"], segment) for job in jobs]
+            )
+            self.db.executemany("DELETE FROM jobs WHERE guild_id = ? AND job_id = ?", [(guild_id, job["job_id"]) for job in jobs])
+
+    def segment_sizes(self, guild_id):
+        """{segment: number of jobs} of a guild's archive."""
+        return dict(self.db.execute("SELECT segment, COUNT(*) FROM archived_jobs WHERE guild_id = ? GROUP BY segment", (guild_id,)).fetchall())
+
+    def move_segments(self, guild_id, segments, segment):
+        with self.db:
+            self.db.executemany("UPDATE archived_jobs SET segment = ? WHERE guild_id = ? AND segment = ?", [(segment, guild_id, old) for old in segments])
+
+    def delete_guild(self, guild_id):
+        with self.db:
+            self.db.execute("DELETE FROM jobs WHERE guild_id = ?", (guild_id,))
+            self.db.execute("DELETE FROM archived_jobs WHERE guild_id = ?", (guild_id,))
+
+    def import_jobs(self, guild_id, jobs):
+        """Copy jobs from the old Config `jobs` dict, skipping those already imported."""
+        rows = []
+        for job_id, job in jobs.items():
+            status = "complete" if job.get("completed") else job.get("status", "open")
+            rows.append((guild_id, int(job_id), *(status if name == "status" else job.get(name) for name in FIELDS)))
+        with self.db:
+            self.db.executemany(f"INSERT OR IGNORE INTO jobs (guild_id, job_id, {', '.join(FIELDS)}) VALUES ({', '.join('?' * (len(FIELDS) + 2))})", rows)
@@ -0,0 +1,308 @@
+from array import array
+from datetime import datetime, timezone
+import json
+import os
+import struct
+
+from .qualify import Qualifiers, key_from_json
+
+_HEADER = struct.Struct("<4sIddI")  # magic, window, tracking_since and saved_at timestamps, member count
+_MEMBER = struct.Struct("<QqI")  # member id, head day, channel count
+_CHANNEL = struct.Struct("<Q")  # channel id, followed by the channel's buckets
+_COUNT = struct.Struct("<I")
+_CHECKPOINT = struct.Struct("<QQ")  # channel or thread id, last processed message id
+_CHANNEL_ACTIVITY = struct.Struct("<Qd")  # channel id, decayed message count
+_DAY = struct.Struct("<q")
+_MAGIC = b"RRA4"
+
+ACTIVITY_DECAY = 0.9  # Daily decay of the channel activity stats, recent activity weighs the most
+
+# Until the conditions are known, count every message and the messages that are not links only
+DEFAULT_KEYS = [(), (("count_only_link_messages", True),)]
+
+
+def day_number(when):
+    """Return the UTC day index (days since the epoch) of a datetime."""
+    return int(when.timestamp() // 86400)
+
+
+class MemberActivity:
+    """A member's day buckets, one ring buffer per channel they posted in, all sharing the same head day."""
+
+    __slots__ = ("head", "channels")
+
+    def __init__(self, head):
+        self.head = head
+        self.channels = {}  # channel_id -> array of window * columns counters
+
+
+class ActivityIndex:
+    """Rolling-window message counters for a single guild.
+
+    Every member keeps `window` day slots per channel, days older than the window are overwritten as the
+    ring buffer moves forward, so memory only depends on the window and not on how long the bot has run.
+    Each day slot has one column per qualifier key, i.e. per distinct set of message filters in the guild.
+    Threads are counted under their parent channel so conditions can filter by channel id.
+    """
+
+    def __init__(self, window=31, tracking_since=None, keys=None):
+        self.window = window
+        self.qualifiers = Qualifiers(DEFAULT_KEYS if keys is None else keys)
+        self.columns = len(self.qualifiers.keys)
+        self.members = {}  # member_id -> MemberActivity
+        self.checkpoints = {}  # channel or thread id -> id of the last message counted in it
+        self.channel_activity = {}  # channel_id -> decayed message count, used to read the busiest channels first
+        self.activity_day = day_number(datetime.now(timezone.utc))
+        self.tracking_since = tracking_since or datetime.now(timezone.utc)
+        self.saved_at = None
+        self._empty = array("I", bytes(4 * window * self.columns))
+
+    def covers(self, timeframe):
+        """Whether the counters have been tracking for at least `timeframe`."""
+        return self.tracking_since <= datetime.now(timezone.utc) - timeframe
+
+    def _advance(self, activity, day):
+        """Move a member's head to `day`, clearing the slots of the days that fall out of the window."""
+        steps = day - activity.head
+        if steps <= 0:
+            return
+        window = self.window
+        if steps >= window:
+            for buckets in activity.channels.values():
+                buckets[:] = self._empty
+        else:
+            columns = self.columns
+            for d in range(activity.head + 1, day + 1):
+                slot = (d % window) * columns
+                for buckets in activity.channels.values():
+                    for column in range(slot, slot + columns):
+                        buckets[column] = 0
+        activity.head = day
+
+    def add_counts(self, member_id, channel_id, day, counts):
+        activity = self.members.get(member_id)
+        if activity is None:
+            activity = self.members[member_id] = MemberActivity(day)
+        self._advance(activity, day)
+        if day <= activity.head - self.window:
+            return  # Already out of the window
+        buckets = activity.channels.get(channel_id)
+        if buckets is None:
+            buckets = activity.channels[channel_id] = array("I", self._empty)
+        slot = (day % self.window) * self.columns
+        for column, delta in enumerate(counts):
+            if delta:
+                buckets[slot + column] = max(buckets[slot + column] + delta, 0)
+
+    def checkpoint(self, channel_id, message_id):
+        if message_id > self.checkpoints.get(channel_id, 0):
+            self.checkpoints[channel_id] = message_id
+
+    def column(self, key):
+        return self.qualifiers.keys.index(key)
+
+    def add(self, message, channel_id, delta=1):
+        """Count a message (or uncount it with a negative delta) in every column it qualifies for."""
+        self.add_counts(message.author.id, channel_id, day_number(message.created_at), self.qualifiers.classify(message, delta))
+        self.channel_activity[channel_id] = max(self.channel_activity.get(channel_id, 0) + delta, 0)
+
+    def busiest_first(self, channels):
+        """Sort channels by their recent activity, busiest first."""
+        activity = self.channel_activity
+        return sorted(channels, key=lambda channel: activity.get(channel.id, 0), reverse=True)
+
+    def window_totals(self, member_id, spans, today=None):
+        """Window sums of a member for several `(since_day, column)` spans, shared by all the guild's conditions.
+
+        Returns None if the member has no activity. See `WindowTotals`.
+        """
+        activity = self.members.get(member_id)
+        if activity is None:
+            return None
+        if today is None:
+            today = day_number(datetime.now(timezone.utc))
+        self._advance(activity, today)
+        return WindowTotals(self, activity, spans)
+
+    def days(self, activity):
+        """Yield `(day, channel_id, counts)` for every non-empty bucket of a member."""
+        window = self.window
+        columns = self.columns
+        for day in range(activity.head - window + 1, activity.head + 1):
+            slot = (day % window) * columns
+            for channel_id, buckets in activity.channels.items():
+                counts = buckets[slot:slot + columns]
+                if any(counts):
+                    yield day, channel_id, counts
+
+    def merge(self, other):
+        """Add another index's counts into this one, e.g. a history backfill that ends where tracking began.
+
+        Columns are matched by qualifier key, columns the other index doesn't have are left untouched.
+        """
+        if other.qualifiers.keys == self.qualifiers.keys:
+            remap = None
+        else:
+            remap = [other.qualifiers.keys.index(key) if key in other.qualifiers.keys else None for key in self.qualifiers.keys]
+        for member_id, activity in other.members.items():
+            for day, channel_id, counts in other.days(activity):
+                if remap is not None:
+                    counts = [0 if column is None else counts[column] for column in remap]
+                self.add_counts(member_id, channel_id, day, counts)
+        for channel_id, message_id in other.checkpoints.items():
+            self.checkpoint(channel_id, message_id)
+        for channel_id, count in other.channel_activity.items():
+            self.channel_activity[channel_id] = self.channel_activity.get(channel_id, 0) + count
+        self.tracking_since = min(self.tracking_since, other.tracking_since)
+
+    def reshape(self, window, keys):
+        """Change the number of day slots and the qualifier columns, keeping what both layouts have in common.
+
+        Returns whether the counters were reset and the whole window has to be read from the history.
+        """
+        if window == self.window and keys == self.qualifiers.keys:
+            return False
+        old = ActivityIndex(self.window, self.tracking_since, self.qualifiers.keys)
+        old.members = self.members
+        old.checkpoints = self.checkpoints
+        old.channel_activity = self.channel_activity
+        self.window = window
+        self.qualifiers = Qualifiers(keys)
+        self.columns = len(self.qualifiers.keys)
+        self.members = {}
+        self.checkpoints = {}
+        self.channel_activity = {}
+        self._empty = array("I", bytes(4 * window * self.columns))
+        if any(key not in old.qualifiers.keys for key in keys):
+            # A new filter combination has no counts yet, start over and read the whole window from the history
+            self.tracking_since = datetime.now(timezone.utc)
+            return True
+        self.merge(old)
+        if window > old.window:
+            # Days beyond the old window were already evicted, they have to be read from the history again.
+            # The oldest day kept is whole, the history is read up to its start so none of it is counted twice.
+            oldest_kept_day = day_number(datetime.now(timezone.utc)) - old.window + 1
+            self.tracking_since = max(self.tracking_since, datetime.fromtimestamp(oldest_kept_day * 86400, timezone.utc))
+        return False
+
+    def evict(self, today=None):
+        """Forget members whose every bucket has left the window."""
+        if today is None:
+            today = day_number(datetime.now(timezone.utc))
+        for member_id in [m for m, activity in self.members.items() if activity.head <= today - self.window]:
+            del self.members[member_id]
+        if today > self.activity_day:
+            factor = ACTIVITY_DECAY ** (today - self.activity_day)
+            self.channel_activity = {channel_id: count * factor for channel_id, count in self.channel_activity.items() if count * factor >= 1}
+            self.activity_day = today
+
+    def to_bytes(self):
+        saved_at = datetime.now(timezone.utc).timestamp()
+        keys = json.dumps(self.qualifiers.keys).encode()
+        parts = [_HEADER.pack(_MAGIC, self.window, self.tracking_since.timestamp(), saved_at, len(self.members)), _COUNT.pack(len(keys)), keys]
+        for member_id, activity in self.members.items():
+            parts.append(_MEMBER.pack(member_id, activity.head, len(activity.channels)))
+            for channel_id, buckets in activity.channels.items():
+                parts.append(_CHANNEL.pack(channel_id))
+                parts.append(buckets.tobytes())
+        parts.append(_COUNT.pack(len(self.checkpoints)))
+        parts.extend(_CHECKPOINT.pack(channel_id, message_id) for channel_id, message_id in self.checkpoints.items())
+        parts.append(_DAY.pack(self.activity_day))
+        parts.append(_COUNT.pack(len(self.channel_activity)))
+        parts.extend(_CHANNEL_ACTIVITY.pack(channel_id, count) for channel_id, count in self.channel_activity.items())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, window, tracking_since, saved_at, member_count = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("Not an activity index file")
+        offset = _HEADER.size
+        (keys_length,) = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        keys = [key_from_json(key) for key in json.loads(data[offset:offset + keys_length])]
+        offset += keys_length
+        index = cls(window, datetime.fromtimestamp(tracking_since, timezone.utc), keys)
+        index.saved_at = datetime.fromtimestamp(saved_at, timezone.utc)
+        size = 4 * window * index.columns
+        for _ in range(member_count):
+            member_id, head, channel_count = _MEMBER.unpack_from(data, offset)
+            offset += _MEMBER.size
+            activity = index.members[member_id] = MemberActivity(head)
+            for _ in range(channel_count):
+                (channel_id,) = _CHANNEL.unpack_from(data, offset)
+                offset += _CHANNEL.size
+                buckets = array("I")
+                buckets.frombytes(data[offset:offset + size])
+                activity.channels[channel_id] = buckets
+                offset += size
+        (checkpoint_count,) = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        for _ in range(checkpoint_count):
+            channel_id, message_id = _CHECKPOINT.unpack_from(data, offset)
+            offset += _CHECKPOINT.size
+            index.checkpoints[channel_id] = message_id
+        (index.activity_day,) = _DAY.unpack_from(data, offset)
+        offset += _DAY.size
+        (channel_count,) = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        for _ in range(channel_count):
+            channel_id, count = _CHANNEL_ACTIVITY.unpack_from(data, offset)
+            offset += _CHANNEL_ACTIVITY.size
+            index.channel_activity[channel_id] = count
+        return index
+
+
+class WindowTotals:
+    """A member's window sums, computed one channel at a time and only when a condition asks for it.
+
+    Each channel's buckets are read once whatever the number of spans, and `count` stops reading channels
+    as soon as a threshold is reached, so members far above it cost a channel or two.
+    """
+
+    def __init__(self, index, activity, spans):
+        self.index = index
+        self.activity = activity
+        self.spans = spans
+        self.channels = {}  # channel_id -> [total per span]
+
+    def channel(self, channel_id):
+        totals = self.channels.get(channel_id)
+        if totals is None:
+            buckets = self.activity.channels.get(channel_id)
+            if buckets is None:
+                totals = [0] * len(self.spans)
+            else:
+                window = self.index.window
+                columns = self.index.columns
+                head = self.activity.head
+                # suffix[column][n] is the sum of the n most recent days
+                suffix = [[0] * (window + 1) for _ in range(columns)]
+                for offset in range(window):
+                    slot = ((head - offset) % window) * columns
+                    for column in range(columns):
+                        suffix[column][offset + 1] = suffix[column][offset] + buckets[slot + column]
+                totals = [suffix[column][max(min(head - since_day + 1, window), 0)] for since_day, column in self.spans]
+            self.channels[channel_id] = totals
+        return totals
+
+    def count(self, channel_ids, span, stop_at=None):
+        """Sum a span over channels, stopping early once the total reaches `stop_at`."""
+        total = 0
+        has_activity = self.activity.channels
+        for channel_id in channel_ids:
+            if channel_id in has_activity:
+                total += self.channel(channel_id)[span]
+                if stop_at is not None and total >= stop_at:
+                    break
+        return total
+
+
+def write_atomic(path, data):
+    """Write `data` to `path` without ever leaving a half-written file behind."""
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
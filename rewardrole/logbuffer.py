@@ -0,0 +1,89 @@
+import discord
+import asyncio
+import io
+
+ERRORS, CHANGES, DETAILS = 0, 1, 2
+LEVELS = {"errors": ERRORS, "changes": CHANGES, "details": DETAILS}
+
+
+class LogBuffer:
+    """Collects log lines per guild and posts them as a digest instead of one message per line.
+
+    The log channel and verbosity are cached and only reloaded after `invalidate`.
+    Lines above the guild's verbosity are dropped before they are buffered.
+    """
+
+    flush_interval = 300
+    max_embed_length = 4096
+    max_message_length = 6000  # Discord's limit for the text of all the embeds of a message
+    max_messages = 3  # Longer digests are attached as a file
+
+    def __init__(self, cog):
+        self.cog = cog
+        self.entries = {}  # guild_id -> [lines]
+        self.settings = {}  # guild_id -> (log channel id, verbosity)
+        self.task = cog.bot.loop.create_task(self.run())
+
+    def invalidate(self, guild):
+        self.settings.pop(guild.id, None)
+
+    async def get_settings(self, guild):
+        settings = self.settings.get(guild.id)
+        if settings is None:
+            guild_config = self.cog.config.guild(guild)
+            settings = self.settings[guild.id] = (await guild_config.log_channel(), LEVELS.get(await guild_config.log_verbosity(), CHANGES))
+        return settings
+
+    async def write(self, guild, message, level):
+        log_channel_id, verbosity = await self.get_settings(guild)
+        if log_channel_id and level <= verbosity:
+            self.entries.setdefault(guild.id, []).append(message)
+
+    async def flush(self, guild):
+        lines = self.entries.pop(guild.id, None)
+        if not lines:
+            return
+        log_channel_id, verbosity = await self.get_settings(guild)
+        log_channel = guild.get_channel(log_channel_id) if log_channel_id else None
+        if not log_channel:
+            return
+        color = await self.cog.bot.get_embed_color(log_channel)
+        # Lines are packed into messages within Discord's limit for all their embeds, then into embeds
+        messages = [
+            [discord.Embed(description="\n".join(embed_lines), color=color) for embed_lines in self.pack(message_lines, self.max_embed_length)]
+            for message_lines in self.pack([line[:self.max_embed_length] for line in lines], self.max_message_length)
+        ]
+        try:
+            if len(messages) > self.max_messages:
+                # Too long for a few messages, attach the whole digest as a file
+                digest = discord.File(io.BytesIO("\n".join(lines).encode()), filename="rewardrole-log.txt")
+                await log_channel.send(f"RewardRole log ({len(lines)} entries)", file=digest)
+            else:
+                for message_embeds in messages:
+                    await log_channel.send(embeds=message_embeds)
+        except discord.HTTPException:
+            pass
+
+    @staticmethod
+    def pack(lines, limit):
+        """Group lines in order so each group joined by newlines stays within `limit` characters."""
+        groups = [[]]
+        length = 0
+        for line in lines:
+            if groups[-1] and length + len(line) + 1 > limit:
+                groups.append([])
+                length = 0
+            groups[-1].append(line)
+            length += len(line) + 1
+        return groups
+
+    async def flush_all(self):
+        for guild_id in list(self.entries):
+            guild = self.cog.bot.get_guild(guild_id)
+            if guild:
+                await self.flush(guild)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_all()
@@ -0,0 +1,67 @@
+import time
+
+# name -> (unit shown by the metrics command, help text of the Prometheus metric)
+COUNTERS = {
+    "history_seconds": ("s", "Wall time spent paging message history."),
+    "permission_seconds": ("s", "Time spent resolving the channels members can send messages in."),
+    "evaluate_seconds": ("s", "Time spent evaluating the conditions from the counters."),
+    "messages": ("", "Messages read from the history."),
+    "api_calls": ("", "Discord API requests made: history pages, archived thread listings and member edits."),
+    "role_edits_applied": ("", "Members whose reward roles were edited."),
+    "role_edits_skipped": ("", "Evaluations that needed no edit because the member's roles already matched."),
+}
+
+
+class Metrics:
+    """Where the cycles spend their time, per guild.
+
+    Every counter is kept twice: a total since the cog loaded, and the value of the guild's last cycle.
+    Role edits are applied in the background, so they land in the cycle running when they are made, if any.
+    """
+
+    def __init__(self):
+        self.totals = {}  # guild_id -> {counter: total since the cog loaded}
+        self.cycles = {}  # guild_id -> counters of the cycle currently running
+        self.last_cycles = {}  # guild_id -> counters of the last finished cycle, plus its duration and end time
+
+    def add(self, guild_id, name, amount=1):
+        totals = self.totals.setdefault(guild_id, dict.fromkeys(COUNTERS, 0))
+        totals[name] += amount
+        cycle = self.cycles.get(guild_id)
+        if cycle is not None:
+            cycle[name] += amount
+
+    def start_cycle(self, guild_id):
+        self.cycles[guild_id] = dict.fromkeys(COUNTERS, 0)
+
+    def finish_cycle(self, guild_id, duration):
+        cycle = self.cycles.pop(guild_id, None)
+        if cycle is None:
+            return
+        cycle["duration"] = duration
+        cycle["finished_at"] = time.time()
+        self.last_cycles[guild_id] = cycle
+
+    @staticmethod
+    def messages_per_second(counters):
+        return counters["messages"] / counters["history_seconds"] if counters["history_seconds"] else 0.0
+
+    def to_prometheus(self):
+        """Render every guild's metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, (_, description) in COUNTERS.items():
+            metric = f"rewardrole_{name}_total"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(f'{metric}{{guild="{guild_id}"}} {totals[name]}' for guild_id, totals in self.totals.items())
+        gauges = {
+            "last_cycle_seconds": ("Duration of the last cycle.", lambda cycle: cycle["duration"]),
+            "last_cycle_finished_timestamp_seconds": ("When the last cycle finished.", lambda cycle: cycle["finished_at"]),
+            "last_cycle_messages_per_second": ("Messages read per second of history paging in the last cycle.", self.messages_per_second),
+        }
+        for name, (description, value) in gauges.items():
+            metric = f"rewardrole_{name}"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.extend(f'{metric}{{guild="{guild_id}"}} {value(cycle)}' for guild_id, cycle in self.last_cycles.items())
+        return "\n".join(lines) + "\n"
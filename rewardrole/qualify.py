@@ -0,0 +1,66 @@
+import re
+
+LINK_RE = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
+
+def is_link_only(content):
+    """Whether a message is made of links and whitespace only, in a single pass over the links."""
+    if "http" not in content:
+        return False
+    end = 0
+    for match in LINK_RE.finditer(content):
+        gap = content[end:match.start()]
+        if gap and not gap.isspace():
+            return False
+        end = match.end()
+    rest = content[end:]
+    return end > 0 and (not rest or rest.isspace())
+
+
+def qualifier_key(role_data):
+    """The message filters a condition has turned on, as a hashable key.
+
+    Conditions with the same key count exactly the same messages, so they share a column of counters.
+    """
+    key = []
+    if role_data.get("count_only_link_messages", False):
+        key.append(("count_only_link_messages", True))
+    filters = role_data.get("filters", {})
+    if filters.get("min_length"):
+        key.append(("min_length", filters["min_length"]))
+    if filters.get("skip_attachment_only"):
+        key.append(("skip_attachment_only", True))
+    if filters.get("ignored_prefixes"):
+        key.append(("ignored_prefixes", tuple(filters["ignored_prefixes"])))
+    return tuple(key)
+
+
+def key_from_json(data):
+    return tuple((name, tuple(value) if isinstance(value, list) else value) for name, value in data)
+
+
+def build_pipeline(key):
+    """Turn a qualifier key into a tuple of checks, filters that are off don't get a check at all."""
+    checks = []
+    for name, value in key:
+        if name == "count_only_link_messages":
+            checks.append(lambda message: not is_link_only(message.content))
+        elif name == "min_length":
+            checks.append(lambda message, min_length=value: len(message.content) >= min_length)
+        elif name == "skip_attachment_only":
+            checks.append(lambda message: bool(message.content) or not message.attachments)
+        elif name == "ignored_prefixes":
+            checks.append(lambda message, prefixes=value: not message.content.startswith(prefixes))
+    return tuple(checks)
+
+
+class Qualifiers:
+    """The compiled pipelines of a guild, one per distinct qualifier key."""
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.pipelines = [build_pipeline(key) for key in self.keys]
+
+    def classify(self, message, delta=1):
+        """Return, for every pipeline, `delta` if the message counts for it and 0 otherwise."""
+        return [delta if all(check(message) for check in checks) else 0 for checks in self.pipelines]
@@ -1,8 +1,19 @@
 import discord
 from redbot.core import commands, Config
+from redbot.core.data_manager import cog_data_path
 from datetime import timedelta, datetime, timezone
 import asyncio
-import re
+import heapq
+import random
+import struct
+import time
+
+from .activity import ActivityIndex, day_number, write_atomic
+from .qualify import qualifier_key
+from .logbuffer import LogBuffer, LEVELS, ERRORS, CHANGES, DETAILS
+from .roleedits import RoleEditQueue
+from .threads import ThreadRegistry
+from .metrics import Metrics, COUNTERS
 
 class RewardRole(commands.Cog):
     def __init__(self, bot):
@@ -10,84 +21,602 @@ class RewardRole(commands.Cog):
         self.config = Config.get_conf(self, identifier=1995987654321, force_registration=True)
         default_guild = {
             "roles": {},
-            "log_channel": None
+            "log_channel": None,
+            "scan_concurrency": 4,
+            "role_edits_per_minute": 30,
+            "log_verbosity": "changes",
+            "below_since": {},  # member_id -> {reward_role_id: timestamp since which they no longer qualify}
+            "interval_hours": 4,
+            "last_run": None,
+            "last_duration": None,
+            "next_run": None
         }
         self.config.register_guild(**default_guild)
+        self.config.register_global(guild_concurrency=3, write_metrics=False)
+        self.activity = {}  # guild_id -> ActivityIndex, fed by the message listeners
+        self.configured_guilds = set()  # Guilds with role conditions, the listeners ignore the others
+        self.tracking_since = datetime.now(timezone.utc)
+        # The gateway only delivers messages once connected, what was sent between loading and that is read from the history
+        self.first_live = {}  # channel or thread id -> first message the listeners counted in it since the cog loaded
+        self.resume_points = {}  # guild_id -> (saved_at, checkpoints) of counters loaded from disk and not caught up yet
+        self.threads = {}  # guild_id -> ThreadRegistry
+        self.metrics = Metrics()
+        self.role_edits = RoleEditQueue(self)
+        self.logs = LogBuffer(self)
+        self.reevaluations = {}  # guild_id -> ids of members waiting for a targeted evaluation
+        self.reevaluation_event = asyncio.Event()
+        self.running_guilds = {}  # guild_id -> task of the cycle currently running for it
         self.bg_task = self.bot.loop.create_task(self.update_roles())
+        self.reevaluation_task = self.bot.loop.create_task(self.reevaluate_members())
+
+    async def cog_load(self):
+        # Reload the counters saved by the previous run so a restart doesn't need a backfill
+        self.activity_path = cog_data_path(self) / "activity"
+        self.activity_path.mkdir(parents=True, exist_ok=True)
+        self.configured_guilds = {guild_id for guild_id, guild_data in (await self.config.all_guilds()).items() if guild_data.get("roles")}
+        for path in self.activity_path.glob("*.bin"):
+            if int(path.stem) not in self.configured_guilds:
+                continue
+            try:
+                index = ActivityIndex.from_bytes(path.read_bytes())
+            except (ValueError, struct.error):
+                continue  # Corrupted or outdated file, the guild will be backfilled
+            self.activity[int(path.stem)] = index
+            # Snapshot the checkpoints before the listeners move them past the messages sent while offline
+            self.resume_points[int(path.stem)] = (index.saved_at, dict(index.checkpoints))
+        self.threads_path = cog_data_path(self) / "threads"
+        self.threads_path.mkdir(parents=True, exist_ok=True)
+        for path in self.threads_path.glob("*.bin"):
+            if int(path.stem) not in self.configured_guilds:
+                continue
+            try:
+                self.threads[int(path.stem)] = ThreadRegistry.from_bytes(path.read_bytes())
+            except (ValueError, struct.error):
+                continue  # The archived threads will be listed again
+
+    async def cog_unload(self):
+        self.bg_task.cancel()
+        for task in self.running_guilds.values():
+            task.cancel()
+        self.reevaluation_task.cancel()
+        self.role_edits.cancel()
+        self.logs.task.cancel()
+        await self.logs.flush_all()
+        for guild_id in list(self.activity):
+            await self.save_activity(guild_id)
+
+    async def save_activity(self, guild_id):
+        data = self.activity[guild_id].to_bytes()
+        path = self.activity_path / f"{guild_id}.bin"
+        await self.bot.loop.run_in_executor(None, write_atomic, path, data)
+        if guild_id in self.threads:
+            data = self.threads[guild_id].to_bytes()
+            path = self.threads_path / f"{guild_id}.bin"
+            await self.bot.loop.run_in_executor(None, write_atomic, path, data)
 
     async def update_roles(self):
+        """Run each guild's cycle when it is due, a few guilds at a time, the most overdue first."""
         await self.bot.wait_until_ready()
+        running = self.running_guilds
         while not self.bot.is_closed():
+            now = time.time()
+            guild_data = await self.config.all_guilds()
+            due = []
             for guild in self.bot.guilds:
-                roles = await self.config.guild(guild).roles()
-                for role_id, role_data in roles.items():
-                    role = guild.get_role(int(role_id))
-                    reward_role = guild.get_role(role_data["reward_role"])
-                    excluded_roles = [guild.get_role(excluded_role_id) for excluded_role_id in role_data["excluded_roles"]]
-                    for member in guild.members:
-                        try:
-                            if role in member.roles and not any(excluded_role in member.roles for excluded_role in excluded_roles):
-                                min_messages = role_data["min_messages"]
-                                timeframe = timedelta(days=role_data["timeframe_days"])
-                                user_message_count = 0
-                                count_only_link_messages = role_data.get("count_only_link_messages", False)
-                                for channel in guild.channels:
-                                    # Check if member has the permissions to send messages in the channel
-                                    permissions = channel.permissions_for(member)
-                                    if not permissions.send_messages:
-                                        continue
-                                    overwrites = channel.overwrites_for(role)
-                                    if overwrites.send_messages is False:
-                                        continue
-                                    if channel.category_id in role_data.get("ignored_categories", []):
-                                        continue
-                                    if isinstance(channel, discord.TextChannel) or isinstance(channel, discord.Thread):
-                                        if channel.id in role_data.get("ignored_channels", []):
-                                            continue
-                                        # await self.log(guild, f'Checking messages in channel {channel.name}')  # Debug Log
-                                        user_message_count += await self.process_channel_or_thread(channel, member, timeframe, count_only_link_messages, guild)
-                                    if isinstance(channel, discord.ForumChannel):
-                                        if channel.id in role_data.get("ignored_channels", []):
-                                            continue
-                                        for thread in channel.threads:
-                                            # await self.log(guild, f'Checking messages in thread {thread.name}')  # Debug Log
-                                            user_message_count += await self.process_channel_or_thread(thread, member, timeframe, count_only_link_messages, guild)
-
-                                await self.log(guild, f'Finished processing member {member.mention}. Message count: **{user_message_count}**')  # Debug Log
-                                if user_message_count >= min_messages:
-                                    if reward_role not in member.roles:
-                                        await self.log(guild, f'Adding reward role to {member.mention}')  # Debug Log
-                                        await member.add_roles(reward_role)
-                                else:
-                                    if reward_role in member.roles:
-                                        await self.log(guild, f'Removing reward role from {member.mention}')  # Debug Log
-                                        await member.remove_roles(reward_role)
-                        except Exception as e:
-                            await self.log(guild, f'An error occurred while processing member {member.mention}: {str(e)}')  # Error Log
-                            continue  # Continue with the next member even if an error occurred
-            await asyncio.sleep(4 * 60 * 60)  # Run the task every 4 hours
-
-    async def process_channel_or_thread(self, channel_or_thread, member, timeframe, count_only_link_messages, guild):
-        message_count = 0
+                # Guilds without conditions have nothing to evaluate, they aren't scheduled until they get one
+                if guild.id in running or guild.id not in self.configured_guilds:
+                    continue
+                next_run = guild_data.get(guild.id, {}).get("next_run")
+                if next_run is None:
+                    # Never ran here, spread the first runs out instead of starting every guild at once
+                    next_run = now + random.uniform(0, 60)
+                    await self.config.guild(guild).next_run.set(next_run)
+                if next_run <= now:
+                    due.append((next_run, guild))
+            due.sort(key=lambda item: item[0])
+            free = max(await self.config.guild_concurrency(), 1) - len(running)
+            for next_run, guild in due[:max(free, 0)]:
+                running[guild.id] = asyncio.create_task(self.run_guild(guild))
+            if running:
+                await asyncio.wait(running.values(), timeout=30, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(30)
+            for guild_id in [guild_id for guild_id, task in running.items() if task.done()]:
+                del running[guild_id]
+
+    async def run_guild(self, guild):
+        """Run a guild's cycle and schedule the next one, with some jitter so guilds drift apart."""
+        started = time.time()
+        self.metrics.start_cycle(guild.id)
+        try:
+            await self.update_guild(guild)
+        except Exception as e:
+            await self.log(guild, f'An error occurred while updating the reward roles: {str(e)}', ERRORS)
+        self.metrics.finish_cycle(guild.id, time.time() - started)
+        interval = await self.config.guild(guild).interval_hours() * 60 * 60
+        guild_config = self.config.guild(guild)
+        await guild_config.last_run.set(started)
+        await guild_config.last_duration.set(time.time() - started)
+        await guild_config.next_run.set(started + interval + random.uniform(0, interval / 10))
+        if await self.config.write_metrics():
+            await self.write_metrics()
+
+    async def write_metrics(self):
+        """Write the metrics of every guild to `metrics.prom` in the cog's data folder, for a Prometheus textfile collector."""
+        data = self.metrics.to_prometheus().encode()
+        await self.bot.loop.run_in_executor(None, write_atomic, cog_data_path(self) / "metrics.prom", data)
+
+    async def update_guild(self, guild):
+        """Run one evaluation cycle for a guild: refresh the counters if needed, then queue the role changes."""
+        roles = await self.config.guild(guild).roles()
+        if not roles:
+            return
+        index = self.get_activity(guild)
+        longest = timedelta(days=max(role_data["timeframe_days"] for role_data in roles.values()))
+        reset = index.reshape(longest.days + 1, self.qualifier_keys(roles))
+        resume_point = self.resume_points.pop(guild.id, None)
+        await self.refresh_threads(guild, roles, longest, resume_point[0] if resume_point else None)
+        if resume_point and not reset:
+            # After a reset the backfill reads the whole window, the time spent offline included
+            await self.catch_up_guild(guild, roles, index, *resume_point)
+        if not index.covers(longest):
+            # Counters are cold (or a longer timeframe was configured), read the missing history once
+            await self.backfill_guild(guild, roles, index, longest)
+        await self.evaluate(guild, roles, index)
+        await self.logs.flush(guild)
+        index.evict()
+        self.get_threads(guild).evict(discord.utils.time_snowflake(datetime.now(timezone.utc) - longest))
+        await self.save_activity(guild.id)
+
+    def queue_reevaluation(self, member):
+        self.reevaluations.setdefault(member.guild.id, set()).add(member.id)
+        self.reevaluation_event.set()
+
+    async def reevaluate_members(self):
+        """Evaluate the members queued by the member listeners from the counters, without waiting for the next cycle."""
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            await self.reevaluation_event.wait()
+            await asyncio.sleep(5)  # Let bulk role edits settle so they are evaluated together
+            self.reevaluation_event.clear()
+            queued, self.reevaluations = self.reevaluations, {}
+            for guild_id, member_ids in queued.items():
+                guild = self.bot.get_guild(guild_id)
+                if guild is None:
+                    continue
+                try:
+                    roles = await self.config.guild(guild).roles()
+                    if not roles:
+                        continue
+                    index = self.ready_activity(guild, roles)
+                    if index is None:
+                        continue  # The counters can't answer yet, the next full cycle will evaluate these members
+                    members = [member for member in map(guild.get_member, member_ids) if member is not None]
+                    await self.evaluate(guild, roles, index, members, priority=True)
+                except Exception as e:
+                    await self.log(guild, f'An error occurred while reevaluating members: {str(e)}', ERRORS)
+
+    def ready_activity(self, guild, roles):
+        """The guild's index if its counters can answer every condition over its whole timeframe, otherwise None."""
+        index = self.activity.get(guild.id)
+        if index is None or guild.id in self.resume_points:
+            return None  # Counters loaded from disk miss the messages sent while offline until the next cycle catches up
+        longest = timedelta(days=max(role_data["timeframe_days"] for role_data in roles.values()))
+        if not index.covers(longest) or index.window < longest.days + 1 or set(self.qualifier_keys(roles)) - set(index.qualifiers.keys):
+            return None
+        return index
+
+    async def evaluate(self, guild, roles, index, members=None, priority=False):
+        """Evaluate the conditions from the counters and queue the role changes.
+
+        `members` defaults to every member a condition applies to.
+        """
+        evaluate_started = time.perf_counter()
+        permission_time = 0.0
+        overwritten = self.members_with_overwrites(guild)
+        conditions, spans = self.build_conditions(guild, roles, index)
+
+        members_given = members is not None
+        if members is None:
+            members = {}
+            for condition in conditions:
+                for member in condition["role"].members:
+                    members[member.id] = member
+            members = members.values()
+
+        # One pass over the members, all conditions share their counts
+        desired = {}  # member -> {reward_role_id: whether any condition grants it}
+        grace = {}  # reward_role_id -> longest grace period before it's removed
+        for member in members:
+            try:
+                member_role_ids = {member_role.id for member_role in member.roles}
+                key = None
+                totals = None
+                for condition in conditions:
+                    if not self.applies_to(condition, member_role_ids):
+                        continue
+                    started = time.perf_counter()
+                    if key is None:
+                        key = self.permission_key(member, overwritten)
+                        totals = index.window_totals(member.id, spans)
+                    counted_channels = self.counted_channel_ids(condition, member, key)
+                    permission_time += time.perf_counter() - started
+                    # Channels are sorted busiest first, most members reach the threshold after a few of them
+                    user_message_count = totals.count(counted_channels, condition["span"], stop_at=condition["min_messages"]) if totals else 0
+
+                    reward_role = condition["reward_role"]
+                    await self.log(guild, f'Finished processing member {member.mention} for {condition["role"].name}. Message count: **{user_message_count}**{"+" if user_message_count >= condition["min_messages"] else ""}', DETAILS)
+                    # Members who have the reward role keep it down to the lower remove threshold
+                    threshold = condition["remove_below"] if reward_role.id in member_role_ids else condition["min_messages"]
+                    grants = desired.setdefault(member, {})
+                    grants[reward_role.id] = grants.get(reward_role.id, False) or user_message_count >= threshold
+                    grace[reward_role.id] = max(grace.get(reward_role.id, timedelta()), condition["grace"])
+            except Exception as e:
+                await self.log(guild, f'An error occurred while processing member {member.mention}: {str(e)}', ERRORS)
+                continue  # Continue with the next member even if an error occurred
+        # Removals wait for the grace period, a member back above the threshold by then keeps the role
         now = datetime.now(timezone.utc)
-        earliest_time = now - timeframe
-        async for message in channel_or_thread.history(limit=None, after=earliest_time):
-            if message.author == member:
-                if count_only_link_messages:
-                    urls = re.findall('http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', message.content)
-                    non_link_content = re.sub('http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', '', message.content).strip()
-                    if not urls or non_link_content:
-                        message_count += 1
+        async with self.config.guild(guild).below_since() as below_since:
+            if not members_given:
+                # Forget members who left, only a full sweep sees every member
+                for member_id in [member_id for member_id in below_since if guild.get_member(int(member_id)) is None]:
+                    del below_since[member_id]
+            for member, grants in desired.items():
+                member_role_ids = {member_role.id for member_role in member.roles}
+                pending = below_since.get(str(member.id), {})
+                for reward_role_id, granted in grants.items():
+                    if granted or reward_role_id not in member_role_ids:
+                        pending.pop(str(reward_role_id), None)
+                    elif grace.get(reward_role_id):
+                        since = datetime.fromtimestamp(pending.setdefault(str(reward_role_id), now.timestamp()), timezone.utc)
+                        if now - since < grace[reward_role_id]:
+                            grants[reward_role_id] = None  # Still within the grace period, leave the role alone
+                        else:
+                            del pending[str(reward_role_id)]
+                if pending:
+                    below_since[str(member.id)] = pending
                 else:
-                    message_count += 1
+                    below_since.pop(str(member.id), None)
+
+        # Only members whose roles differ from the evaluation are queued for an edit
+        for member, grants in desired.items():
+            add = {reward_role_id for reward_role_id, granted in grants.items() if granted}
+            remove = {reward_role_id for reward_role_id, granted in grants.items() if granted is False}
+            self.role_edits.submit(member, add, remove, priority)
+        self.metrics.add(guild.id, "permission_seconds", permission_time)
+        self.metrics.add(guild.id, "evaluate_seconds", time.perf_counter() - evaluate_started)
+
+    def build_conditions(self, guild, roles, index):
+        """Resolve the guild's role conditions against the index.
+
+        Returns the conditions and the `(since_day, column)` spans their counts are read from, conditions
+        with the same timeframe and filters share a span.
+        """
+        span_indexes = {}  # (earliest day, column) -> position in spans
+        conditions = []
+        for role_id, role_data in roles.items():
+            role = guild.get_role(int(role_id))
+            reward_role = guild.get_role(role_data["reward_role"])
+            if role is None or reward_role is None:
+                continue
+            timeframe = timedelta(days=role_data["timeframe_days"])
+            column = index.column(qualifier_key(role_data))
+            span = (day_number(datetime.now(timezone.utc) - timeframe), column)
+            conditions.append({
+                "role": role,
+                "reward_role": reward_role,
+                "excluded_role_ids": set(role_data["excluded_roles"]),
+                "min_messages": role_data["min_messages"],
+                "remove_below": role_data.get("remove_below", role_data["min_messages"]),
+                "grace": timedelta(hours=role_data.get("grace_hours", 0)),
+                "span": span_indexes.setdefault(span, len(span_indexes)),
+                "candidate_channels": self.condition_channels(guild, role, role_data, index),
+                "channels_by_key": {}  # permission key -> ids of the channels members with that key can send messages in
+            })
+        return conditions, list(span_indexes)
+
+    @staticmethod
+    def applies_to(condition, member_role_ids):
+        """Whether a condition counts a member with these roles."""
+        return condition["role"].id in member_role_ids and not member_role_ids & condition["excluded_role_ids"]
+
+    @staticmethod
+    def counted_channel_ids(condition, member, key):
+        """IDs of the condition's channels `member` can send messages in, busiest first, shared by members with the same permission key."""
+        counted_channels = condition["channels_by_key"].get(key)
+        if counted_channels is None:
+            # Check if member has the permissions to send messages in the channel
+            counted_channels = condition["channels_by_key"][key] = [channel.id for channel in condition["candidate_channels"] if channel.permissions_for(member).send_messages]
+        return counted_channels
+
+    @staticmethod
+    def condition_channels(guild, role, role_data, index):
+        """Channels a condition counts, busiest first, before checking the member's own permissions."""
+        channels = []
+        for channel in guild.channels:
+            if not isinstance(channel, (discord.TextChannel, discord.ForumChannel)):
+                continue
+            if channel.overwrites_for(role).send_messages is False:
+                continue
+            if channel.category_id in role_data.get("ignored_categories", []) or channel.id in role_data.get("ignored_channels", []):
+                continue
+            channels.append(channel)
+        return index.busiest_first(channels)
+
+    @staticmethod
+    def members_with_overwrites(guild):
+        """IDs of members that have a permission overwrite of their own in any channel."""
+        return {target.id for channel in guild.channels for target in channel.overwrites if not isinstance(target, discord.Role)}
+
+    @staticmethod
+    def permission_key(member, overwritten):
+        """Everything channel permissions depend on for a member, members sharing a key share their permissions."""
+        if member.id in overwritten or member.id == member.guild.owner_id:
+            return member.id
+        return (frozenset(role.id for role in member.roles), member.is_timed_out())
+
+    def tracked_channels(self, guild, roles):
+        """Channels that at least one role condition counts messages in."""
+        for channel in guild.channels:
+            if not isinstance(channel, (discord.TextChannel, discord.ForumChannel)):
+                continue
+            if all(channel.id in role_data.get("ignored_channels", []) or channel.category_id in role_data.get("ignored_categories", []) for role_data in roles.values()):
+                continue
+            yield channel
+
+    async def backfill_guild(self, guild, roles, index, timeframe):
+        """Read every tracked channel and thread once, tallying all members' messages in a single pass.
+
+        Only history older than what the listeners already counted is fetched, so the result can be merged into `index`.
+        """
+        earliest_time = datetime.now(timezone.utc) - timeframe
+        tally = ActivityIndex(index.window, earliest_time, index.qualifiers.keys)
+        # An index started with the cog was only fed from each channel's first live message, not from the load
+        started_with_cog = index.tracking_since == self.tracking_since
+        # Threads created after tracking began were counted by the listeners from their first message
+        threads = self.get_threads(guild).by_parent(discord.utils.time_snowflake(earliest_time), None if started_with_cog else discord.utils.time_snowflake(index.tracking_since))
+        jobs = []
+        # Busiest channels first, they hold most of the counts
+        for channel in index.busiest_first(self.tracked_channels(guild, roles)):
+            for channel_or_thread in self.scan_targets(guild, channel, threads):
+                before = self.live_since(channel_or_thread.id) if started_with_cog else index.tracking_since
+                jobs.append((channel_or_thread, channel.id, earliest_time, before))
+        await self.scan_history(guild, jobs, tally)
+        index.merge(tally)
+
+    async def catch_up_guild(self, guild, roles, index, saved_at, checkpoints):
+        """Count the messages sent while the bot was offline, reading each channel from its last checkpoint."""
+        window_start = discord.utils.time_snowflake(datetime.now(timezone.utc) - timedelta(days=index.window - 1))
+        offline_since = discord.utils.time_snowflake(saved_at)
+        # Only the threads with messages since the bot went offline
+        threads = self.get_threads(guild).by_parent(max(offline_since, window_start))
+        jobs = []
+        for channel in self.tracked_channels(guild, roles):
+            for channel_or_thread in self.scan_targets(guild, channel, threads):
+                after = max(checkpoints.get(channel_or_thread.id, offline_since), window_start)
+                jobs.append((channel_or_thread, channel.id, discord.Object(id=after), self.live_since(channel_or_thread.id)))
+        await self.scan_history(guild, jobs, index)
+
+    def live_since(self, channel_id):
+        """Where the listeners took over a channel or thread: before its first live message, or now if none came yet."""
+        message_id = self.first_live.get(channel_id) or discord.utils.time_snowflake(datetime.now(timezone.utc))
+        return discord.Object(id=message_id)
+
+    def scan_targets(self, guild, channel, threads):
+        """The channel itself, unless it's a forum, and its threads from `threads` (see `ThreadRegistry.by_parent`).
+
+        Archived threads are not in the cache, a partial messageable is all that's needed to read their history.
+        """
+        targets = [] if isinstance(channel, discord.ForumChannel) else [channel]
+        for thread_id in threads.get(channel.id, []):
+            targets.append(guild.get_thread(thread_id) or self.bot.get_partial_messageable(thread_id, guild_id=guild.id))
+        return targets
+
+    async def refresh_threads(self, guild, roles, timeframe, resumed_at=None):
+        """Register the active threads from the cache and list the archived threads the registry doesn't know yet.
+
+        A channel's archived threads are listed once down to the start of the timeframe, or again if the timeframe
+        grew. After a restart only the threads archived while the bot was offline are listed.
+        """
+        registry = self.get_threads(guild)
+        for thread in guild.threads:
+            if self.counted_channel(thread) is not None:
+                registry.touch(thread.id, thread.parent_id, thread.last_message_id)
+        window_start = datetime.now(timezone.utc) - timeframe
+        since = discord.utils.time_snowflake(window_start)
+        for channel in self.tracked_channels(guild, roles):
+            if registry.needs_listing(channel.id, since):
+                if await self.list_archived_threads(guild, channel, registry, window_start):
+                    registry.listed[channel.id] = since
+            elif resumed_at is not None:
+                await self.list_archived_threads(guild, channel, registry, max(resumed_at, window_start))
+
+    async def list_archived_threads(self, guild, channel, registry, until):
+        """Register a channel's threads archived since `until`, newest first. Returns whether the listing completed."""
+        listings = [channel.archived_threads(limit=None)]
+        if isinstance(channel, discord.TextChannel):
+            listings.append(channel.archived_threads(limit=None, private=True))
+        try:
+            for listing in listings:
+                listed = 0
+                try:
+                    async for thread in listing:
+                        # A thread's messages all predate its archival
+                        if thread.archive_timestamp < until:
+                            break
+                        registry.touch(thread.id, channel.id, thread.last_message_id)
+                        listed += 1
+                finally:
+                    self.metrics.add(guild.id, "api_calls", listed // 50 + 1)  # Pages of up to 50 threads
+        except discord.Forbidden:
+            pass  # Private threads need the Manage Threads permission, the public ones were listed
+        except discord.HTTPException as e:
+            await self.log(guild, f'Could not list the archived threads of {channel.mention}: {str(e)}', ERRORS)
+            return False
+        return True
+
+    async def scan_history(self, guild, jobs, tally):
+        """Read many channels and threads at once, with at most `scan_concurrency` of them in flight.
+
+        discord.py waits on each route's rate-limit bucket by itself, and history buckets are per channel,
+        so scanning different channels side by side doesn't run into more 429s.
+        """
+        concurrency = await self.config.guild(guild).scan_concurrency()
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        progress = {"done": 0, "messages": 0}
+        started = time.monotonic()
+
+        def describe():
+            elapsed = time.monotonic() - started
+            done = progress["done"]
+            text = f'{done}/{len(jobs)} channels, {progress["messages"]} messages'
+            if 0 < done < len(jobs):
+                eta = elapsed / done * (len(jobs) - done)
+                text += f', ETA {timedelta(seconds=int(eta))}'
+            return text
+
+        async def scan(channel_or_thread, counted_channel_id, after, before):
+            async with semaphore:
+                messages_before = progress["messages"]
+                try:
+                    await self.process_channel_or_thread(channel_or_thread, counted_channel_id, tally, after, before, progress)
+                except discord.HTTPException as e:
+                    await self.log(guild, f'Could not read the history of {channel_or_thread.mention}: {str(e)}', ERRORS)
+                progress["done"] += 1
+                self.metrics.add(guild.id, "api_calls", (progress["messages"] - messages_before) // 100 + 1)  # Pages of up to 100 messages
+
+        async def report():
+            while True:
+                await asyncio.sleep(60)
+                await self.log(guild, f'Scanning message history: {describe()}', CHANGES)
+                await self.logs.flush(guild)
+
+        reporter = asyncio.create_task(report())
+        try:
+            await asyncio.gather(*(scan(*job) for job in jobs))
+        finally:
+            reporter.cancel()
+            self.metrics.add(guild.id, "history_seconds", time.monotonic() - started)
+            self.metrics.add(guild.id, "messages", progress["messages"])
+        await self.log(guild, f'Finished scanning message history: {describe()} in {timedelta(seconds=int(time.monotonic() - started))}', CHANGES)
+
+    async def process_channel_or_thread(self, channel_or_thread, counted_channel_id, tally, after, before, progress=None):
+        """Tally every message in `channel_or_thread` between `after` and `before` by author and day."""
+        message_count = 0
+        async for message in channel_or_thread.history(limit=None, after=after, before=before):
+            tally.add(message, counted_channel_id)
+            tally.checkpoint(channel_or_thread.id, message.id)
+            message_count += 1
+            if progress is not None:
+                progress["messages"] += 1
         return message_count
-            
-    async def log(self, guild, message):
-        log_channel_id = await self.config.guild(guild).log_channel()
-        if log_channel_id:
-            log_channel = guild.get_channel(log_channel_id)
-            if log_channel:
-                await log_channel.send(message)
+
+    @staticmethod
+    def qualifier_keys(roles):
+        """The distinct message filter combinations of a guild's conditions, each gets a column of counters."""
+        return list(dict.fromkeys(qualifier_key(role_data) for role_data in roles.values()))
+
+    @staticmethod
+    def counted_channel(channel):
+        """Return the channel a message in `channel` counts towards, or None if it is not tracked."""
+        if isinstance(channel, discord.TextChannel):
+            return channel
+        if isinstance(channel, discord.Thread) and isinstance(channel.parent, (discord.TextChannel, discord.ForumChannel)):
+            return channel.parent
+        return None
+
+    def get_activity(self, guild):
+        index = self.activity.get(guild.id)
+        if index is None:
+            index = self.activity[guild.id] = ActivityIndex(tracking_since=self.tracking_since)
+        return index
+
+    def get_threads(self, guild):
+        registry = self.threads.get(guild.id)
+        if registry is None:
+            registry = self.threads[guild.id] = ThreadRegistry()
+        return registry
+
+    def set_configured(self, guild, roles):
+        """Start or stop counting a guild's messages after its role conditions changed."""
+        if roles and guild.id not in self.configured_guilds:
+            # Nothing was counted while the guild had no conditions, the history before now gets backfilled
+            self.configured_guilds.add(guild.id)
+            self.activity[guild.id] = ActivityIndex(tracking_since=datetime.now(timezone.utc))
+            self.threads.pop(guild.id, None)
+            self.resume_points.pop(guild.id, None)
+        elif not roles:
+            self.configured_guilds.discard(guild.id)
+            self.activity.pop(guild.id, None)
+            self.threads.pop(guild.id, None)
+            self.resume_points.pop(guild.id, None)
+
+    def record_message(self, message, delta=1):
+        if message.guild is None or message.guild.id not in self.configured_guilds:
+            return
+        channel = self.counted_channel(message.channel)
+        if channel is None:
+            return
+        index = self.get_activity(message.guild)
+        index.add(message, channel.id, delta)
+        if delta > 0:
+            self.first_live.setdefault(message.channel.id, message.id)
+            index.checkpoint(message.channel.id, message.id)
+            if channel is not message.channel:
+                self.get_threads(message.guild).touch(message.channel.id, channel.id, message.id)
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        self.record_message(message)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        self.queue_reevaluation(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.roles == after.roles:
+            return
+        roles = await self.config.guild(after.guild).roles()
+        relevant = {int(role_id) for role_id in roles}
+        for role_data in roles.values():
+            relevant.update(role_data["excluded_roles"])
+        changed = {role.id for role in before.roles} ^ {role.id for role in after.roles}
+        if changed & relevant:
+            self.queue_reevaluation(after)
+
+    @commands.Cog.listener()
+    async def on_thread_create(self, thread):
+        if thread.guild.id in self.configured_guilds and self.counted_channel(thread) is not None:
+            self.get_threads(thread.guild).touch(thread.id, thread.parent_id, thread.last_message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_thread_update(self, payload):
+        # Archiving doesn't change what a thread holds, unarchiving makes it active again, both are raw for uncached threads
+        guild = self.bot.get_guild(payload.guild_id)
+        if guild is None or guild.id not in self.configured_guilds or not isinstance(guild.get_channel(payload.parent_id), (discord.TextChannel, discord.ForumChannel)):
+            return
+        self.get_threads(guild).touch(payload.thread_id, payload.parent_id, int(payload.data.get("last_message_id") or 0))
+
+    @commands.Cog.listener()
+    async def on_raw_thread_delete(self, payload):
+        registry = self.threads.get(payload.guild_id)
+        if registry is not None:
+            registry.remove(payload.thread_id)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        # Only cached messages tell us who the author was
+        if payload.cached_message:
+            self.record_message(payload.cached_message, delta=-1)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        for message in payload.cached_messages:
+            self.record_message(message, delta=-1)
+
+    async def log(self, guild, message, level=CHANGES):
+        await self.logs.write(guild, message, level)
 
     @commands.group()
     @commands.guild_only()
@@ -110,6 +639,7 @@ class RewardRole(commands.Cog):
                 "ignored_channels": [channel.id for channel in ignored_channels],
                 "ignored_categories": [category.id for category in ignored_categories]
             }
+        self.set_configured(ctx.guild, roles)
 
         await ctx.send(f"Role condition for {role.name} added successfully.")
 
@@ -123,6 +653,7 @@ class RewardRole(commands.Cog):
                 await ctx.send(f"Role condition for {role.name} removed successfully.")
             else:
                 await ctx.send(f"No role condition found for {role.name}.")
+        self.set_configured(ctx.guild, roles)
 
     @rewardrole.command(name="list")
     async def list_role_conditions(self, ctx):
@@ -140,6 +671,7 @@ class RewardRole(commands.Cog):
             ignored_channels = [ctx.guild.get_channel(channel_id) for channel_id in role_data["ignored_channels"]]
             ignored_categories = [ctx.guild.get_channel(category_id) for category_id in role_data["ignored_categories"]]
             count_only_link_messages = role_data.get("count_only_link_messages", False)
+            filters = role_data.get("filters", {})
 
             # Create an embed for each role
             default_color = await ctx.embed_color()
@@ -148,12 +680,16 @@ class RewardRole(commands.Cog):
                 name="Details",
                 value=(
                     f"**Min messages:** {role_data['min_messages']}\n"
+                    f"**Remove below:** {role_data.get('remove_below', role_data['min_messages'])} messages, after {role_data.get('grace_hours', 0)} hours\n"
                     f"**Timeframe:** {role_data['timeframe_days']} days\n"
                     f"**Reward role:** {reward_role.mention}\n"
                     f"**Count messages that only contain links:** {'Yes' if count_only_link_messages else 'No'}\n"
                     f"**Excluded roles:** {', '.join([r.mention for r in excluded_roles if r])}\n"
                     f"**Ignored channels:** {', '.join([ch.mention for ch in ignored_channels if ch])}\n"
-                    f"**Ignored categories:** {', '.join([cat.name for cat in ignored_categories if cat])}"
+                    f"**Ignored categories:** {', '.join([cat.name for cat in ignored_categories if cat])}\n"
+                    f"**Min message length:** {filters.get('min_length') or 'None'}\n"
+                    f"**Skip attachment-only messages:** {'Yes' if filters.get('skip_attachment_only') else 'No'}\n"
+                    f"**Ignored prefixes:** {' '.join(f'`{prefix}`' for prefix in filters.get('ignored_prefixes', [])) or 'None'}"
                 ),
                 inline=False
             )
@@ -161,6 +697,237 @@ class RewardRole(commands.Cog):
 
         await self.paginate_roles(ctx, pages)
 
+    @rewardrole.command(name="status")
+    async def show_member_status(self, ctx, member: discord.Member):
+        """Show a member's message count for each role condition, with the channels it comes from."""
+        roles = await self.config.guild(ctx.guild).roles()
+        if not roles:
+            await ctx.send("No role conditions have been configured.")
+            return
+        index = self.ready_activity(ctx.guild, roles)
+        if index is None:
+            await ctx.send("The activity counters are still being built, try again after the next cycle.")
+            return
+
+        conditions, spans = self.build_conditions(ctx.guild, roles, index)
+        member_role_ids = {member_role.id for member_role in member.roles}
+        key = self.permission_key(member, self.members_with_overwrites(ctx.guild))
+        totals = index.window_totals(member.id, spans)
+        default_color = await ctx.embed_color()
+        embed = discord.Embed(title=f"Activity of {member.display_name}", color=default_color)
+        for condition in conditions:
+            if not self.applies_to(condition, member_role_ids):
+                continue
+            reward_role = condition["reward_role"]
+            has_reward = reward_role.id in member_role_ids
+            threshold = condition["remove_below"] if has_reward else condition["min_messages"]
+            breakdown = []
+            if totals:
+                for channel_id in self.counted_channel_ids(condition, member, key):
+                    channel_count = totals.count([channel_id], condition["span"])
+                    if channel_count:
+                        breakdown.append((channel_count, channel_id))
+            breakdown.sort(reverse=True)
+            user_message_count = sum(channel_count for channel_count, _ in breakdown)
+            lines = [
+                f"**Message count:** {user_message_count} / {threshold} {'to keep' if has_reward else 'to earn'} {reward_role.mention}",
+                *(f"<#{channel_id}>: {channel_count}" for channel_count, channel_id in breakdown[:10])
+            ]
+            if len(breakdown) > 10:
+                lines.append(f"... and {len(breakdown) - 10} more channels")
+            embed.add_field(name=condition["role"].name, value="\n".join(lines), inline=False)
+        if not embed.fields:
+            await ctx.send(f"No role condition applies to {member.display_name}.")
+            return
+        await ctx.send(embed=embed)
+
+    @rewardrole.command(name="leaderboard")
+    async def show_leaderboard(self, ctx, role: discord.Role, top: int = 10):
+        """Show the members of a role condition with the most counted messages."""
+        roles = await self.config.guild(ctx.guild).roles()
+        if str(role.id) not in roles:
+            await ctx.send(f"No role condition found for {role.name}.")
+            return
+        index = self.ready_activity(ctx.guild, roles)
+        if index is None:
+            await ctx.send("The activity counters are still being built, try again after the next cycle.")
+            return
+
+        conditions, spans = self.build_conditions(ctx.guild, {str(role.id): roles[str(role.id)]}, index)
+        if not conditions:
+            await ctx.send(f"The reward role of {role.name} no longer exists.")
+            return
+        condition = conditions[0]
+        overwritten = self.members_with_overwrites(ctx.guild)
+
+        def counts():
+            # Only members with activity can be on the board, the index has all of them
+            for member_id in list(index.members):
+                member = ctx.guild.get_member(member_id)
+                if member is None or not self.applies_to(condition, {member_role.id for member_role in member.roles}):
+                    continue
+                counted_channels = self.counted_channel_ids(condition, member, self.permission_key(member, overwritten))
+                user_message_count = index.window_totals(member_id, spans).count(counted_channels, condition["span"])
+                if user_message_count:
+                    yield user_message_count, member_id
+
+        leaders = heapq.nlargest(min(max(top, 1), 25), counts())
+        if not leaders:
+            await ctx.send(f"No messages have been counted for {role.name} yet.")
+            return
+        lines = [f"**{rank}.** <@{member_id}>: {user_message_count}" for rank, (user_message_count, member_id) in enumerate(leaders, start=1)]
+        default_color = await ctx.embed_color()
+        embed = discord.Embed(title=f"Most active members of {role.name}", description="\n".join(lines), color=default_color)
+        embed.set_footer(text=f"{condition['min_messages']} messages earn {condition['reward_role'].name}")
+        await ctx.send(embed=embed)
+
+    @rewardrole.command(name="hysteresis")
+    async def set_hysteresis(self, ctx, role: discord.Role, remove_below: int, grace_hours: int = 0):
+        """
+        Stop the reward role from flapping for members around the threshold.
+
+        Members who have the reward role only lose it once they drop below `remove_below` messages (at most the condition's minimum), and only after staying there for `grace_hours`.
+        """
+        async with self.config.guild(ctx.guild).roles() as roles:
+            role_data = roles.get(str(role.id))
+            if role_data is None:
+                await ctx.send(f"No role condition found for {role.name}.")
+                return
+            if not 0 <= remove_below <= role_data["min_messages"] or grace_hours < 0:
+                await ctx.send(f"The remove threshold must be between 0 and {role_data['min_messages']}, and the grace period can't be negative.")
+                return
+            role_data["remove_below"] = remove_below
+            role_data["grace_hours"] = grace_hours
+        await ctx.send(f"Members of {role.name} will lose the reward role below {remove_below} messages, after a {grace_hours} hour grace period.")
+
+    @rewardrole.command(name="filter")
+    async def set_message_filter(self, ctx, role: discord.Role, name: str, *values: str):
+        """
+        Set a message filter for a role condition.
+
+        `minlength <characters>`: only count messages at least this long, 0 to disable.
+        `attachments <true|false>`: don't count messages that only contain attachments.
+        `prefixes [prefixes...]`: don't count messages starting with one of these prefixes, e.g. bot commands. Give none to disable.
+        """
+        name = name.lower()
+        async with self.config.guild(ctx.guild).roles() as roles:
+            if str(role.id) not in roles:
+                await ctx.send(f"No role condition found for {role.name}.")
+                return
+            filters = roles[str(role.id)].setdefault("filters", {})
+            try:
+                if name == "minlength":
+                    filters["min_length"] = max(int(values[0]), 0)
+                elif name == "attachments":
+                    filters["skip_attachment_only"] = values[0].lower() in ("true", "yes", "on", "1")
+                elif name == "prefixes":
+                    filters["ignored_prefixes"] = list(values)
+                else:
+                    await ctx.send("Unknown filter, use `minlength`, `attachments` or `prefixes`.")
+                    return
+            except (IndexError, ValueError):
+                await ctx.send_help()
+                return
+        await ctx.send(f"Filter updated for {role.name}. Counters for a new filter combination are rebuilt on the next cycle.")
+
+    @rewardrole.command(name="rescan")
+    async def rescan(self, ctx):
+        """Drop the activity counters and rebuild them from the message history."""
+        roles = await self.config.guild(ctx.guild).roles()
+        if not roles:
+            await ctx.send("No role conditions have been configured.")
+            return
+        longest = timedelta(days=max(role_data["timeframe_days"] for role_data in roles.values()))
+        index = self.activity[ctx.guild.id] = ActivityIndex(longest.days + 1, keys=self.qualifier_keys(roles))
+        self.resume_points.pop(ctx.guild.id, None)
+        async with ctx.typing():
+            await self.refresh_threads(ctx.guild, roles, longest)
+            await self.backfill_guild(ctx.guild, roles, index, longest)
+        await ctx.send("Activity counters have been rebuilt from the message history.")
+
+    @rewardrole.command(name="concurrency")
+    async def set_scan_concurrency(self, ctx, channels: int):
+        """Set how many channels and threads are read at the same time when scanning the message history."""
+        if channels < 1:
+            await ctx.send("The concurrency must be at least 1.")
+            return
+        await self.config.guild(ctx.guild).scan_concurrency.set(channels)
+        await ctx.send(f"Up to {channels} channels will now be scanned at the same time.")
+
+    @rewardrole.command(name="editrate")
+    async def set_role_edit_rate(self, ctx, edits_per_minute: int):
+        """Set how many members can have their reward roles updated per minute."""
+        if edits_per_minute < 1:
+            await ctx.send("The rate must be at least 1 edit per minute.")
+            return
+        await self.config.guild(ctx.guild).role_edits_per_minute.set(edits_per_minute)
+        await ctx.send(f"Reward roles will now be updated for up to {edits_per_minute} members per minute.")
+
+    @rewardrole.command(name="interval")
+    async def set_interval(self, ctx, hours: int):
+        """Set how many hours pass between two full evaluations of this server."""
+        if hours < 1:
+            await ctx.send("The interval must be at least 1 hour.")
+            return
+        guild_config = self.config.guild(ctx.guild)
+        await guild_config.interval_hours.set(hours)
+        last_run = await guild_config.last_run()
+        if last_run:
+            await guild_config.next_run.set(last_run + hours * 60 * 60)
+        await ctx.send(f"This server will be evaluated every {hours} hours.")
+
+    @rewardrole.command(name="schedule")
+    async def show_schedule(self, ctx):
+        """Show when this server was last evaluated and when it will be next."""
+        guild_data = await self.config.guild(ctx.guild).all()
+        last_run = f"<t:{int(guild_data['last_run'])}:R>, took {timedelta(seconds=int(guild_data['last_duration']))}" if guild_data["last_run"] else "Never"
+        next_run = f"<t:{int(guild_data['next_run'])}:R>" if guild_data["next_run"] else "Soon"
+        await ctx.send(f"**Interval:** {guild_data['interval_hours']} hours\n**Last run:** {last_run}\n**Next run:** {next_run}")
+
+    @rewardrole.command(name="guildconcurrency")
+    @commands.is_owner()
+    async def set_guild_concurrency(self, ctx, guilds: int):
+        """Set how many servers can be evaluated at the same time."""
+        if guilds < 1:
+            await ctx.send("The concurrency must be at least 1.")
+            return
+        await self.config.guild_concurrency.set(guilds)
+        await ctx.send(f"Up to {guilds} servers will now be evaluated at the same time.")
+
+    @rewardrole.command(name="metrics")
+    @commands.is_owner()
+    async def show_metrics(self, ctx, guild_id: int = None):
+        """Show where the cycles of a server spend their time, this server by default."""
+        guild_id = guild_id or ctx.guild.id
+        totals = self.metrics.totals.get(guild_id)
+        if totals is None:
+            await ctx.send("No metrics have been recorded for that server since the cog was loaded.")
+            return
+
+        def describe(counters):
+            lines = [f"**{name.replace('_', ' ').capitalize()}:** {counters[name]:.2f}{unit}" if unit else f"**{name.replace('_', ' ').capitalize()}:** {counters[name]}" for name, (unit, _) in COUNTERS.items()]
+            lines.append(f"**Messages per second:** {self.metrics.messages_per_second(counters):.0f}")
+            return "\n".join(lines)
+
+        default_color = await ctx.embed_color()
+        embed = discord.Embed(title="RewardRole metrics", color=default_color)
+        last_cycle = self.metrics.last_cycles.get(guild_id)
+        if last_cycle is not None:
+            embed.add_field(name=f"Last cycle, <t:{int(last_cycle['finished_at'])}:R> in {timedelta(seconds=int(last_cycle['duration']))}", value=describe(last_cycle), inline=False)
+        embed.add_field(name="Since the cog was loaded", value=describe(totals), inline=False)
+        await ctx.send(embed=embed)
+
+    @rewardrole.command(name="metricsfile")
+    @commands.is_owner()
+    async def set_metrics_file(self, ctx, enable: bool):
+        """Write the metrics of every server to `metrics.prom` in the cog's data folder after each cycle, in the Prometheus text format."""
+        await self.config.write_metrics.set(enable)
+        if enable:
+            await self.write_metrics()
+            await ctx.send(f"Metrics will be written to `{cog_data_path(self) / 'metrics.prom'}` after each cycle.")
+        else:
+            await ctx.send("Metrics will no longer be written to a file.")
+
     @rewardrole.command(name="setlog")
     async def set_log_channel(self, ctx, channel: discord.TextChannel, enable: bool):
         """
@@ -172,6 +939,20 @@ class RewardRole(commands.Cog):
         else:
             await self.config.guild(ctx.guild).log_channel.set(None)
             await ctx.send("Logging has been disabled.")
+        self.logs.invalidate(ctx.guild)
+
+    @rewardrole.command(name="verbosity")
+    async def set_log_verbosity(self, ctx, level: str):
+        """
+        Set how much is logged: `errors`, `changes` (role changes and scans) or `details` (every member's message count).
+        """
+        level = level.lower()
+        if level not in LEVELS:
+            await ctx.send(f"Unknown level, use one of: {', '.join(LEVELS)}.")
+            return
+        await self.config.guild(ctx.guild).log_verbosity.set(level)
+        self.logs.invalidate(ctx.guild)
+        await ctx.send(f"Log verbosity set to {level}.")
 
     async def paginate_roles(self, ctx, pages):
         current_page = 0
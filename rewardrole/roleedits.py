@@ -0,0 +1,89 @@
+import discord
+import asyncio
+
+from .logbuffer import ERRORS, CHANGES
+
+
+class RoleEditQueue:
+    """Applies reward role changes in the background, one member edit at a time per guild.
+
+    Pending changes are keyed by member so a newer evaluation replaces an older one that wasn't applied yet,
+    and each guild's worker spaces its edits out to stay within `role_edits_per_minute`.
+    """
+
+    max_attempts = 5
+
+    def __init__(self, cog):
+        self.cog = cog
+        self.pending = {}  # guild_id -> {member_id: (role ids to add, role ids to remove)}
+        self.urgent = {}  # guild_id -> same as pending, applied before it
+        self.workers = {}  # guild_id -> asyncio.Task
+
+    def submit(self, member, add, remove, priority=False):
+        """Queue a change, unless the member's roles already match it.
+
+        Priority changes, e.g. from a member's roles being edited, skip ahead of the ones from the full sweep.
+        """
+        guild = member.guild
+        current = {role.id for role in member.roles}
+        add = {role_id for role_id in add if role_id not in current}
+        remove = {role_id for role_id in remove if role_id in current}
+        # Any change queued earlier is outdated now
+        self.pending.get(guild.id, {}).pop(member.id, None)
+        self.urgent.get(guild.id, {}).pop(member.id, None)
+        if not add and not remove:
+            self.cog.metrics.add(guild.id, "role_edits_skipped")
+            return
+        queue = self.urgent if priority else self.pending
+        queue.setdefault(guild.id, {})[member.id] = (add, remove)
+        worker = self.workers.get(guild.id)
+        if worker is None or worker.done():
+            self.workers[guild.id] = asyncio.create_task(self.run(guild))
+
+    def cancel(self):
+        for worker in self.workers.values():
+            worker.cancel()
+
+    async def run(self, guild):
+        pending = self.pending.setdefault(guild.id, {})
+        urgent = self.urgent.setdefault(guild.id, {})
+        while urgent or pending:
+            queue = urgent or pending
+            member_id = next(iter(queue))
+            add, remove = queue.pop(member_id)
+            member = guild.get_member(member_id)
+            if member is not None:
+                await self.apply(member, add, remove)
+            edits_per_minute = await self.cog.config.guild(guild).role_edits_per_minute()
+            await asyncio.sleep(60 / max(edits_per_minute, 1))
+
+    async def apply(self, member, add, remove):
+        guild = member.guild
+        for attempt in range(1, self.max_attempts + 1):
+            # Recompute from the cached roles right before editing, they may have changed while queued
+            current = {role.id for role in member.roles}
+            added = [role for role in map(guild.get_role, add - current) if role is not None]
+            removed = [role for role in member.roles if role.id in remove]
+            if not added and not removed:
+                self.cog.metrics.add(guild.id, "role_edits_skipped")
+                return
+            # One request per role, each only adds or removes its role, so changes made by others in the meantime stay
+            self.cog.metrics.add(guild.id, "api_calls", len(added) + len(removed))
+            try:
+                if added:
+                    await member.add_roles(*added, reason="RewardRole activity conditions")
+                if removed:
+                    await member.remove_roles(*removed, reason="RewardRole activity conditions")
+            except discord.HTTPException as e:
+                if e.status == 429 and attempt < self.max_attempts:
+                    retry_after = float(e.response.headers.get("Retry-After", 2 ** attempt))
+                    await asyncio.sleep(retry_after)
+                    continue
+                await self.cog.log(guild, f'Could not update the roles of {member.mention}: {str(e)}', ERRORS)
+                return
+            self.cog.metrics.add(guild.id, "role_edits_applied")
+            for role in added:
+                await self.cog.log(guild, f'Adding reward role <@&{role.id}> to {member.mention}', CHANGES)
+            for role in removed:
+                await self.cog.log(guild, f'Removing reward role <@&{role.id}> from {member.mention}', CHANGES)
+            return
@@ -0,0 +1,72 @@
+import struct
+
+_HEADER = struct.Struct("<4sII")  # magic, thread count, listed parent count
+_THREAD = struct.Struct("<QQQ")  # thread id, parent channel id, id of the last message seen in it
+_LISTED = struct.Struct("<QQ")  # parent channel id, snowflake down to which its archived threads were listed
+_MAGIC = b"RRT1"
+
+
+class ThreadRegistry:
+    """The threads of a guild that can hold counted messages, active or archived, with their last activity.
+
+    `channel.threads` only lists the active threads in the cache, archived ones have to be paged from the API.
+    That happens once per parent channel, after that the thread and message events keep the registry current,
+    so a cycle only reads the threads that had messages inside its window.
+    """
+
+    def __init__(self):
+        self.threads = {}  # thread_id -> [parent_id, id of the last message seen in it]
+        self.listed = {}  # parent_id -> snowflake down to which its archived threads have been listed
+
+    def touch(self, thread_id, parent_id, message_id=None):
+        """Record activity in a thread, `message_id` defaults to the thread's creation."""
+        message_id = message_id or thread_id
+        entry = self.threads.get(thread_id)
+        if entry is None:
+            self.threads[thread_id] = [parent_id, message_id]
+        elif message_id > entry[1]:
+            entry[1] = message_id
+
+    def remove(self, thread_id):
+        self.threads.pop(thread_id, None)
+
+    def needs_listing(self, parent_id, since):
+        """Whether the archived threads of a channel haven't been listed down to the `since` snowflake yet."""
+        listed = self.listed.get(parent_id)
+        return listed is None or listed > since
+
+    def by_parent(self, after, before=None):
+        """Group the ids of the threads with messages after `after` and created before `before` by parent channel."""
+        grouped = {}
+        for thread_id, (parent_id, last_message_id) in self.threads.items():
+            if last_message_id > after and (before is None or thread_id < before):
+                grouped.setdefault(parent_id, []).append(thread_id)
+        return grouped
+
+    def evict(self, since):
+        """Forget the threads without messages since the `since` snowflake, they can't count anymore."""
+        for thread_id in [thread_id for thread_id, (_, last_message_id) in self.threads.items() if last_message_id < since]:
+            del self.threads[thread_id]
+
+    def to_bytes(self):
+        parts = [_HEADER.pack(_MAGIC, len(self.threads), len(self.listed))]
+        parts.extend(_THREAD.pack(thread_id, parent_id, last_message_id) for thread_id, (parent_id, last_message_id) in self.threads.items())
+        parts.extend(_LISTED.pack(parent_id, since) for parent_id, since in self.listed.items())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, thread_count, listed_count = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("Not a thread registry file")
+        registry = cls()
+        offset = _HEADER.size
+        for _ in range(thread_count):
+            thread_id, parent_id, last_message_id = _THREAD.unpack_from(data, offset)
+            registry.threads[thread_id] = [parent_id, last_message_id]
+            offset += _THREAD.size
+        for _ in range(listed_count):
+            parent_id, since = _LISTED.unpack_from(data, offset)
+            registry.listed[parent_id] = since
+            offset += _LISTED.size
+        return registry